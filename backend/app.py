@@ -1,26 +1,26 @@
+import time
+STARTED = time.perf_counter()
+
 import streamlit as st
 from songs import MetaSet
-from database import Database
+from tags import genres, instruments, moods_themes
+from metrics import METRICS
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
-import gdown
-
-genres = ["electronic", "rock", "pop", "ambient", "soundtrack", "alternative", "experimental",     "easylistening", "classical", "dance", "chillout", "jazz", "poprock", "indie", "world",     "folk", "techno", "hiphop", "lounge", "house", "funk", "orchestral", "popfolk",     "atmospheric", "trance", "instrumentalpop", "newage", "blues", "metal", "progressive",     "electropop", "triphop", "reggae", "downtempo", "minimal", "rap", "rnb", "punkrock",     "psychedelic", "instrumentalrock", "industrial", "latin", "dubstep", "drumnbass",     "ethno", "fusion", "club",
-          "symphonic", "country", "electronica", "disco",     "singersongwriter", "darkambient", "breakbeat", "soul", "synthpop", "dub", "hardrock",     "rocknroll", "80s", "contemporary", "eurodance", "grunge", "improvisation", "postrock",     "groove", "90s", "alternativerock", "deephouse", "celtic", "jazzfunk", "idm", "bossanova",     "darkwave", "swing", "70s", "acidjazz", "classicrock", "newwave", "oriental", "hard",     "chanson", "ethnicrock", "jazzfusion", "60s", "choir", "edm", "ska", "gothic",     "worldfusion", "bluesrock", "heavymetal", "medieval", "tribal", "african"]
 
-instruments = ["piano", "synthesizer", "bass", "drums", "guitar", "electricguitar",     "acousticguitar", "violin", "voice", "computer", "keyboard", "strings",     "drummachine", "flute", "electricpiano", "cello", "saxophone", "trumpet",     "percussion",
-               "sampler", "orchestra", "beat", "classicalguitar", "bell",     "doublebass", "accordion", "harp", "viola", "horn", "rhodes", "pipeorgan",     "brass", "acousticbassguitar", "organ", "clarinet", "trombone", "harmonica",     "pad", "ukulele", "bongo", "oboe"]
+# torch, msclap, faiss and langchain are imported by the background
+# loaders in start_database, never on the path to the first render
+IMPORTED = time.perf_counter()
 
-moods_themes = ["love", "happy", "energetic", "dark", "relaxing", "melodic", "sad", "dream",     "film", "emotional", "epic", "romantic", "melancholic", "space", "meditative",     "uplifting", "ballad", "inspiring", "calm", "soft", "slow", "fun", "christmas",     "motivational", "positive", "upbeat", "dramatic", "deep", "children",
-                "adventure",     "soundscape", "summer", "powerful", "hopeful", "advertising", "party", "background",     "action", "movie", "drama", "nature", "cool", "funny", "documentary", "horror",     "fast", "ambiental", "groovy", "corporate", "commercial", "travel", "sport",     "mellow", "retro", "game", "sexy", "trailer", "heavy", "holiday"]
 
-
-def main(db):
+def main(startup):
     st.title("Vibes! VibeSync's Playlist Generator 🎵")
 
-    playlist(db)
+    playlist(startup)
+    startup_status(startup)
 
 
-def playlist(db):
+def playlist(startup):
     st.subheader("Retrieve Playlist")
 
     playlist_name = st.text_input("Enter Playlist Name")
@@ -51,19 +51,26 @@ def playlist(db):
                     filter['instrument'] = MetaSet(set(selected_instruments))
                 if len(selected_moods) > 0:
                     filter['moodtheme'] = MetaSet(set(selected_moods))
-                # request playlist
-                playlist = db.get_playlist(
-                    playlist_name, k, filter=filter)
-
-                # show results
-                st.write(f"Songs in '{playlist_name}':")
-                # print(f"Retrieved {len(playlist)} songs!")
-                for song, score in playlist:
-                    metadata = song.metadata
-                    # pretty_print_audio_metadata(metadata)
-                    display_song(metadata, score)
-                    # st.write(
-                    # f"- [{metadata['artist']} - {metadata['title']}]({metadata['url']})\n (Score: {score:.2f}) - {metadata['doc_type']}")
+                with METRICS.trace('playlist_request', title=playlist_name, k=k):
+                    if not startup.ready.done():
+                        with st.spinner("Loading the model and song index..."):
+                            startup.ready.result()
+                    db = startup.ready.result()
+
+                    # request playlist
+                    playlist = db.get_playlist(
+                        playlist_name, k, filter=filter)
+
+                    # show results
+                    with METRICS.timer('render'):
+                        st.write(f"Songs in '{playlist_name}':")
+                        # print(f"Retrieved {len(playlist)} songs!")
+                        for song, score in playlist:
+                            metadata = song.metadata
+                            # pretty_print_audio_metadata(metadata)
+                            display_song(metadata, score)
+                            # st.write(
+                            # f"- [{metadata['artist']} - {metadata['title']}]({metadata['url']})\n (Score: {score:.2f}) - {metadata['doc_type']}")
             except Exception as e:
                 st.error(f"Error retrieving playlist: {e}")
         else:
@@ -96,15 +103,74 @@ def pretty_print_audio_metadata(metadata):
         print(f"{key.capitalize():<15}: {value}")
 
 
-@st.cache_resource
+class Startup():
+    """Background model and index loading, with a timing breakdown.
+
+    The CLAP text tower and the song index load in parallel threads while
+    the page renders; ready resolves to the Database once both are done
+    and a warm-up query has run.
+    """
+
+    def __init__(self, name: str):
+        self.timings = {'imports': IMPORTED - STARTED}
+        self.executor = ThreadPoolExecutor(max_workers=3)
+        models = self.executor.submit(self.timed, 'load_models', load_models)
+        db = self.executor.submit(self.timed, 'load_database', load_database, name)
+        self.ready = self.executor.submit(self.warm_up, models, db)
+
+    def timed(self, name: str, load, *args):
+        start = time.perf_counter()
+        try:
+            return load(*args)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def warm_up(self, models: Future, db: Future):
+        models.result()
+        db = db.result()
+        self.timed('warm_up_query', db.audio_text_embeddings.embed_query, 'warm up')
+        self.timings['ready'] = time.perf_counter() - STARTED
+        print('Startup: ' + ', '.join(f'{name} {seconds:.2f}s'
+                                      for name, seconds in self.timings.items()))
+        return db
+
+
+def load_models():
+    from embeddings import MODELS
+    # The app only embeds playlist titles, so skip loading the audio encoder
+    MODELS.configure(towers={'text'})
+    MODELS.get('text')
+
+
 def load_database(name):
-    return Database(name, include_all_embeddings=True)
+    from database import Database
+    db = Database(name, include_all_embeddings=True)
+    # Map the indexes and filter columns now rather than on the first query
+    for store in db.stores.values():
+        store.index
+        store.metadata_index
+    return db
+
+
+@st.cache_resource
+def start_database(name) -> Startup:
+    return Startup(name)
+
+
+def startup_status(startup: Startup):
+    with st.sidebar.expander("Startup time"):
+        if not startup.ready.done():
+            st.write("Loading the model and song index...")
+        for name, seconds in startup.timings.items():
+            st.write(f"{name}: {seconds:.2f}s")
 
 
 if __name__ == "__main__":
+    # VIBESYNC_METRICS=1 serves timers on :9108/metrics (see metrics.py)
+    METRICS.enable_from_env()
     if not os.path.exists("backend/vector_stores/full_jamendo"):
+        import gdown
         url = "https://drive.google.com/drive/folders/1TOF89l81ZW17raWxKRlPyW8WAWAPx0wJ?usp=sharing"
         gdown.download_folder(
             url, quiet=False, use_cookies=False, output="backend/vector_stores/full_jamendo")
-    db = load_database('full_jamendo')
-    main(db)
+    main(start_database('full_jamendo'))
@@ -0,0 +1,97 @@
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio.functional as AF
+import random
+
+
+CHUNK_FRAMES = 1 << 16
+
+
+def window_starts(total_frames: int, window_frames: int, n_windows: int) -> list[int]:
+    """Starts of n windows centred on n equal segments of the track."""
+    last = max(total_frames - window_frames, 0)
+    return [int(min(max((i + 0.5) * total_frames / n_windows - window_frames / 2, 0), last))
+            for i in range(n_windows)]
+
+
+def read_frames(fp: sf.SoundFile, start: int, frames: int,
+                chunk_frames: int = CHUNK_FRAMES) -> np.ndarray:
+    """Decode frames from start as mono, chunk_frames at a time."""
+    out = np.empty(frames, dtype=np.float32)
+    fp.seek(start)
+    read = 0
+    while read < frames:
+        chunk = fp.read(min(chunk_frames, frames - read),
+                        dtype='float32', always_2d=True)
+        if not len(chunk):
+            break
+        out[read:read + len(chunk)] = chunk.mean(axis=1)
+        read += len(chunk)
+    return out[:read]
+
+
+def fit_length(samples: torch.Tensor, length: int) -> torch.Tensor:
+    """Repeat a short clip or trim a long one to exactly length samples."""
+    if len(samples) == 0:
+        return torch.zeros(length)
+    if len(samples) < length:
+        samples = samples.repeat(-(-length // len(samples)))
+    return samples[:length]
+
+
+def load_windows(path: str, sample_rate: int, duration: float, n_windows: int,
+                 chunk_frames: int = CHUNK_FRAMES) -> torch.Tensor:
+    """Decode and resample n evenly spaced windows of duration seconds.
+
+    Only the windows are decoded, one at a time and in chunks, so memory is
+    bounded by the windows rather than the track length. Returns an
+    (n_windows, duration * sample_rate) tensor of mono samples; a track
+    shorter than a window is repeated to fill it, as CLAP does.
+    """
+    length = int(duration * sample_rate)
+    with sf.SoundFile(path) as fp:
+        source_rate = fp.samplerate
+        window_frames = int(np.ceil(duration * source_rate))
+        starts = window_starts(fp.frames, window_frames, n_windows)
+
+        windows = torch.empty((n_windows, length))
+        for i, start in enumerate(starts):
+            samples = torch.from_numpy(read_frames(
+                fp, start, window_frames, chunk_frames))
+            if source_rate != sample_rate:
+                samples = AF.resample(samples, source_rate, sample_rate)
+            windows[i] = fit_length(samples, length)
+    return windows
+
+
+def load_track(path: str, sample_rate: int, chunk_frames: int = CHUNK_FRAMES) -> np.ndarray:
+    """Decode a whole track in chunks as mono samples at sample_rate."""
+    with sf.SoundFile(path) as fp:
+        samples = read_frames(fp, 0, fp.frames, chunk_frames)
+        if fp.samplerate != sample_rate:
+            samples = AF.resample(torch.from_numpy(samples),
+                                  fp.samplerate, sample_rate).numpy()
+    return samples
+
+
+def as_float(samples: np.ndarray) -> torch.Tensor:
+    """Float samples in [-1, 1] from float or 16-bit PCM samples."""
+    if samples.dtype == np.int16:
+        return torch.from_numpy(samples.astype(np.float32) / 32768)
+    return torch.from_numpy(np.asarray(samples, dtype=np.float32))
+
+
+def slice_windows(samples: np.ndarray, length: int, n_windows: int) -> torch.Tensor:
+    """The load_windows clips, cut from already decoded samples.
+
+    Only the clips are converted, so samples can be a memory map.
+    """
+    return torch.stack([fit_length(as_float(samples[start:start + length]), length)
+                        for start in window_starts(len(samples), length, n_windows)])
+
+
+def random_clip(samples: np.ndarray, length: int) -> torch.Tensor:
+    """One clip at a random offset, as CLAP cuts from a whole file."""
+    start = random.randrange(max(len(samples) - length, 0) + 1)
+    return fit_length(as_float(samples[start:start + length]), length)
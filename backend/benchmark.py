@@ -0,0 +1,236 @@
+"""Time ingest, checkpoint, load and query paths on a synthetic catalog.
+
+Example:
+    python backend/benchmark.py --tracks 100k --out bench.json --baseline baseline.json
+"""
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+import argparse
+import resource
+import hashlib
+import shutil
+import torch
+import json
+import time
+import os
+
+from embeddings import MODELS
+from tags import TAG_STATS_DIR, TAG_FIELDS
+from songs import Song, MetaSet
+import database
+
+
+# Tracks in MTG-Jamendo autotagging, the denominator of the tag stats
+MTG_TRACKS = 55701
+TAG_STATS = {'genre': 'genre.tsv', 'instrument': 'instrument.tsv',
+             'moodtheme': 'mood_theme.tsv'}
+PERCENTILES = (50, 95, 99)
+
+
+class StubCLAP():
+    """Deterministic stand-in for CLAP: a unit vector seeded by each input.
+
+    Audio inputs are hashed by path, so files never need to exist.
+    """
+
+    def vector(self, prefix: str, value: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(
+            f'{prefix}:{value}'.encode(), digest_size=8).digest(), 'little')
+        vector = np.random.default_rng(seed).standard_normal(
+            MODELS.dim(), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get_text_embeddings(self, texts: list[str]) -> torch.Tensor:
+        return torch.from_numpy(np.stack([self.vector('text', text) for text in texts]))
+
+    def get_audio_embeddings(self, files: list[str], resample: bool = True) -> torch.Tensor:
+        return torch.from_numpy(np.stack([self.vector('audio', file) for file in files]))
+
+
+def tag_frequencies() -> dict:
+    """Per-field tags and the fraction of MTG-Jamendo tracks carrying each."""
+    frequencies = {}
+    for field, filename in TAG_STATS.items():
+        with open(os.path.join(TAG_STATS_DIR, filename)) as fp:
+            rows = [line.rstrip('\n').split('\t') for line in fp][1:]
+        frequencies[field] = ([row[0] for row in rows],
+                              np.array([int(row[3]) for row in rows]) / MTG_TRACKS)
+    return frequencies
+
+
+def synthetic_catalog(n: int, batch_size: int = 1000, seed: int = 0):
+    """Yield batches of n songs whose tags follow the MTG-Jamendo marginals."""
+    rng = np.random.default_rng(seed)
+    frequencies = tag_frequencies()
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        has_tag = {field: rng.random((size, len(p))) < p
+                   for field, (_, p) in frequencies.items()}
+        durations = rng.lognormal(np.log(240), 0.4, size)
+        songs = []
+        for j in range(size):
+            i = start + j
+            tags = {field: {frequencies[field][0][t] for t in np.flatnonzero(has_tag[field][j])}
+                    for field in TAG_FIELDS}
+            songs.append(Song(f'synthetic track {i}', f'synthetic/{i}.mp3', id=i,
+                              artist=f'artist {i % 5000}', duration=float(durations[j]),
+                              genre=tags['genre'], instrument=tags['instrument'],
+                              moodtheme=tags['moodtheme']))
+        yield songs
+
+
+def query_filters(rng: np.random.Generator, n: int) -> list[dict]:
+    """Filters over common tags and duration ranges, as the app builds them."""
+    frequencies = tag_frequencies()
+    filters = []
+    for i in range(n):
+        field = TAG_FIELDS[i % len(TAG_FIELDS)]
+        tags, _ = frequencies[field]
+        filter = {field: MetaSet(set(rng.choice(tags[:10], 2, replace=False)))}
+        if i % 2:
+            filter['duration'] = (120.0, 360.0)
+        filters.append(filter)
+    return filters
+
+
+@contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(seconds: list[float]) -> dict:
+    ms = np.array(seconds) * 1000
+    summary = {f'p{q}_ms': float(np.percentile(ms, q)) for q in PERCENTILES}
+    summary.update({'mean_ms': float(ms.mean()), 'count': len(ms)})
+    return summary
+
+
+def open_database(name: str, args) -> database.Database:
+    db = database.Database(name, not args.audio_only, index_spec=args.index,
+                           checkpoint_interval=None, vector_dtype=args.dtype)
+    # Stub vectors are cheap to recompute and must not reach the real cache
+    for embeddings in (db.text_embeddings, db.audio_embeddings):
+        embeddings.cache = None
+    db.result_cache.ttl = 0
+    return db
+
+
+def run(args) -> dict:
+    """Run every stage and return the results as a JSON-ready dict."""
+    MODELS.set(StubCLAP())
+    name = f'benchmark_{args.tracks}'
+    path = os.path.join('backend/vector_stores', name)
+    shutil.rmtree(path, ignore_errors=True)
+    results = {'config': {'tracks': args.tracks, 'batch_size': args.batch_size,
+                          'queries': args.queries, 'k': args.k, 'index': args.index,
+                          'dtype': args.dtype, 'audio_only': args.audio_only,
+                          'seed': args.seed},
+               'stages': {}}
+    stages = results['stages']
+
+    try:
+        with quiet():
+            db = open_database(name, args)
+        batches = []
+        for songs in synthetic_catalog(args.tracks, args.batch_size, args.seed):
+            start = time.perf_counter()
+            with quiet():
+                db.post_songs(songs)
+            batches.append(time.perf_counter() - start)
+        stages['post_songs'] = {**summarize(batches),
+                                'songs_per_sec': args.tracks / sum(batches),
+                                'peak_rss_mb': peak_rss_mb()}
+        print(f'post_songs: {stages["post_songs"]["songs_per_sec"]:.0f} songs/sec')
+
+        start = time.perf_counter()
+        with quiet():
+            db.save_db()
+        stages['save_db'] = {'seconds': time.perf_counter() - start,
+                             'peak_rss_mb': peak_rss_mb()}
+        print(f'save_db: {stages["save_db"]["seconds"]:.2f}s')
+        del db
+
+        loads = []
+        for _ in range(args.load_repeats):
+            start = time.perf_counter()
+            with quiet():
+                db = open_database(name, args)
+                # First query pays for the lazily mapped index and columns
+                db.get_playlist('cold start query', args.k)
+            loads.append(time.perf_counter() - start)
+        stages['cold_load'] = {**summarize(loads), 'peak_rss_mb': peak_rss_mb()}
+        print(f'cold load: {stages["cold_load"]["p50_ms"]:.1f} ms')
+
+        rng = np.random.default_rng(args.seed)
+        filters = query_filters(rng, args.queries)
+        for stage, filter_for in (('get_playlist', lambda i: None),
+                                  ('get_playlist_filtered', lambda i: filters[i])):
+            seconds = []
+            for i in range(args.queries):
+                title = f'{stage} query {i}'
+                start = time.perf_counter()
+                with quiet():
+                    db.get_playlist(title, args.k, filter_for(i))
+                seconds.append(time.perf_counter() - start)
+            stages[stage] = {**summarize(seconds), 'peak_rss_mb': peak_rss_mb()}
+            print(f'{stage}: p50 {stages[stage]["p50_ms"]:.2f} ms, '
+                  f'p99 {stages[stage]["p99_ms"]:.2f} ms')
+    finally:
+        if not args.keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Ratio of every timing and memory figure to the baseline's (>1 is slower)."""
+    ratios = {}
+    for stage, row in results['stages'].items():
+        base = baseline['stages'].get(stage, {})
+        ratios[stage] = {key: value / base[key] for key, value in row.items()
+                         if (key.endswith('_ms') or key in ('seconds', 'peak_rss_mb'))
+                         and base.get(key)}
+    for stage, row in ratios.items():
+        print(f'{stage:<24}' + ''.join(f'{key} x{ratio:.2f}  ' for key, ratio in row.items()))
+    return ratios
+
+
+def parse_count(value: str) -> int:
+    """10000, 10k or 1M."""
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1].lower(), 1)
+    return int(float(value[:-1] if scale > 1 else value) * scale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=parse_count, default='10k',
+                        help='catalog size, e.g. 10k, 100k or 1M')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--load-repeats', type=int, default=3)
+    parser.add_argument('--index', help="index spec, e.g. 'flat', 'ivf', 'hnsw'")
+    parser.add_argument('--dtype', choices=('float32', 'float16', 'int8'))
+    parser.add_argument('--audio-only', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the benchmark store afterwards')
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            results['vs_baseline'] = compare(results, json.load(fp))
+    if args.out:
+        with open(args.out, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,184 @@
+"""Index a catalog of audio files with one CLAP model per process.
+
+Example:
+    python backend/bulk_index.py full_jamendo backend/audio/jamendo \
+        --tsv mtgdataset/data/autotagging.tsv --workers 8 --threads 2
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import argparse
+import time
+import os
+
+from embeddings import MODELS, CACHE, EmbeddingCache, AudioEmbeddings
+from feature_store import FeatureStore
+from songs import Song
+
+
+def find_audio(paths: list[str]) -> list[str]:
+    """Expand directories into the .mp3 files under them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                files.extend(os.path.join(root, filename)
+                             for filename in sorted(filenames) if filename.lower().endswith('.mp3'))
+        else:
+            files.append(path)
+    return files
+
+
+def init_worker(torch_threads: int):
+    """Load only the audio tower, once per worker process."""
+    import torch
+    torch.set_num_threads(torch_threads)
+    MODELS.configure(towers={'audio'})
+    MODELS.get('audio')
+
+
+def embed_chunk(shm_name: str, shape: tuple, start: int, files: list[str],
+                windows: int = None, features: str = None) -> list[bool]:
+    """Embed files into rows start.. of the shared array; returns per-file success."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        embeddings = AudioEmbeddings(cache=None, windows=windows,
+                                     features=FeatureStore(features) if features else None)
+        try:
+            out[start:start + len(files)] = embeddings.embed_documents(files)
+            return [True] * len(files)
+        except Exception:
+            pass
+
+        # Retry one by one so a single bad file only loses itself
+        ok = []
+        for i, file in enumerate(files):
+            try:
+                out[start + i] = embeddings.embed_documents([file])[0]
+                ok.append(True)
+            except Exception as e:
+                print(f'Failed to embed {file}: {e}')
+                ok.append(False)
+        return ok
+    finally:
+        shm.close()
+
+
+def embed_files(files: list[str], workers: int = os.cpu_count(), torch_threads: int = 1,
+                chunk_size: int = 64, cache: EmbeddingCache = CACHE,
+                windows: int = None, features: str = None) -> tuple[np.ndarray, np.ndarray]:
+    """Embed audio files across a process pool.
+
+    Returns the (len(files), dim) embedding matrix and a boolean mask of
+    the files that embedded successfully. Files already in the embedding
+    cache are not sent to the workers. windows pools that many streamed
+    clips per file (see AudioEmbeddings), and features is the path of a
+    FeatureStore to read decoded audio from.
+    """
+    shape = (len(files), MODELS.dim())
+    embeddings = np.zeros(shape, dtype=np.float32)
+    ok = np.zeros(len(files), dtype=bool)
+
+    keys = [AudioEmbeddings(windows=windows).key(file)
+            for file in files] if cache else []
+    if cache:
+        for i, vector in enumerate(cache.get_many(keys)):
+            if vector is not None:
+                embeddings[i] = vector
+                ok[i] = True
+    todo = np.flatnonzero(~ok)
+    print(f'{len(files) - len(todo)} cached, embedding {len(todo)} files with {workers} workers.')
+    if len(todo) == 0:
+        return embeddings, ok
+
+    shm = shared_memory.SharedMemory(
+        create=True, size=len(todo) * shape[1] * 4)
+    try:
+        todo_files = [files[i] for i in todo]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(torch_threads,)) as executor:
+            futures = [executor.submit(embed_chunk, shm.name, (len(todo), shape[1]), start,
+                                       todo_files[start:start + chunk_size], windows, features)
+                       for start in range(0, len(todo), chunk_size)]
+            done = np.concatenate([future.result() for future in futures])
+
+        embedded = np.ndarray((len(todo), shape[1]),
+                              dtype=np.float32, buffer=shm.buf)
+        embeddings[todo] = embedded
+        ok[todo] = done
+        del embedded
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if cache:
+        fresh = todo[done]
+        cache.put_many([keys[i] for i in fresh], embeddings[fresh])
+    return embeddings, ok
+
+
+def make_songs(files: list[str], tracks: dict = None) -> list[Song]:
+    """Songs for files; MTG-Jamendo tags are attached when tracks is given."""
+    songs = []
+    for file in files:
+        stem = os.path.splitext(os.path.basename(file))[0]
+        track = tracks.get(int(stem)) if tracks and stem.isdigit() else None
+        if track is None:
+            songs.append(Song(stem.replace('_', ' '), file, id=stem))
+            continue
+        songs.append(Song(stem, file, id=stem, duration=track['duration'],
+                          genre=track['genre'], instrument=track['instrument'],
+                          moodtheme=track['mood/theme']))
+    return songs
+
+
+def bulk_index(db, files: list[str], tracks: dict = None, workers: int = os.cpu_count(),
+               torch_threads: int = 1, chunk_size: int = 64, windows: int = None,
+               features: str = None) -> int:
+    """Embed files in parallel and merge them into db; returns songs added."""
+    start = time.perf_counter()
+    embeddings, ok = embed_files(
+        files, workers, torch_threads, chunk_size, windows=windows, features=features)
+    songs = [song for song, good in zip(make_songs(files, tracks), ok) if good]
+    audio_embeddings = embeddings[ok].tolist()
+    print(f'Embedded {len(songs)} songs in {time.perf_counter() - start:.1f}s.')
+
+    # MTG-Jamendo has no titles; a title that is only the track id would
+    # put noise in the text index and every mixed result
+    titled = [db.include_all_embeddings and song.title != song.id for song in songs]
+    for with_text in (True, False):
+        rows = [i for i, has_title in enumerate(titled) if has_title == with_text]
+        if not rows:
+            continue
+        text_embeddings = db.text_embeddings.embed_documents(
+            [songs[i].title for i in rows]) if with_text else []
+        db.add_songs([songs[i] for i in rows],
+                     [audio_embeddings[i] for i in rows], text_embeddings)
+    return len(songs)
+
+
+if __name__ == '__main__':
+    from database import Database
+    from track_table import load_tracks
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('store')
+    parser.add_argument('paths', nargs='+',
+                        help='audio files or directories')
+    parser.add_argument('--tsv', help='MTG-Jamendo metadata TSV')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=1,
+                        help='torch threads per worker')
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--windows', type=int,
+                        help='clips pooled per track (default: one random clip)')
+    parser.add_argument('--features',
+                        help='FeatureStore of decoded audio (see feature_store.py)')
+    args = parser.parse_args()
+
+    tracks = load_tracks(args.tsv) if args.tsv else None
+    db = Database(args.store, True)
+    bulk_index(db, find_audio(args.paths), tracks,
+               args.workers, args.threads, args.chunk_size, args.windows, args.features)
+    db.save_db()
@@ -0,0 +1,34 @@
+"""Column files shared by the vector stores and the track table."""
+import numpy as np
+import shutil
+import os
+
+
+def write_strings(path: str, field: str, values: list[str]):
+    encoded = [value.encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    np.save(os.path.join(path, f'{field}.offsets.npy'), offsets)
+    with open(os.path.join(path, f'{field}.bytes'), 'wb') as fp:
+        fp.write(b''.join(encoded))
+
+
+def open_bytes(path: str):
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return b''
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def append_npy(src: str, dst: str, values: np.ndarray):
+    """Write the array in src followed by values to dst, copying src as is."""
+    saved = np.load(src, mmap_mode='r')
+    if not len(values):
+        shutil.copyfile(src, dst)
+        return
+    out = np.lib.format.open_memmap(dst, mode='w+', dtype=saved.dtype,
+                                    shape=(len(saved) + len(values), *saved.shape[1:]))
+    out[:len(saved)] = saved
+    out[len(saved):] = values
+    out.flush()
+    del out
@@ -1,31 +1,38 @@
 import torch
 import torch.nn.functional as F
-from scipy.stats import pearsonr
-from scipy.spatial.distance import mahalanobis
 
 
 class CustomSimilarity:
+    """Pairwise similarity matrices between two sets of embeddings.
 
-    def __init__(self, method="cosine_similarity", postprocessing="raw"):
+    Every method returns an (N, M) matrix for inputs of shape (N, D) and
+    (M, D). compute_similarity processes embeddings_a in blocks of
+    block_size rows, so intermediates stay O(block_size * M).
+    """
+
+    def __init__(self, method="cosine_similarity", postprocessing="raw", block_size=1024):
         self.method = method
         self.postprocessing = postprocessing
+        self.block_size = block_size
 
     def compute_similarity(self, embeddings_a, embeddings_b):
         if self.method == "cosine_similarity":
-            similarities = self.cosine_similarity(embeddings_a, embeddings_b)
+            similarity = self.cosine_similarity
         elif self.method == "euclidean_distance":
-            similarities = self.euclidean_distance(embeddings_a, embeddings_b)
+            similarity = self.euclidean_distance
         elif self.method == "manhattan_distance":
-            similarities = self.manhattan_distance(embeddings_a, embeddings_b)
+            similarity = self.manhattan_distance
         elif self.method == "jaccard_similarity":
-            similarities = self.jaccard_similarity(embeddings_a, embeddings_b)
+            similarity = self.jaccard_similarity
         elif self.method == "kl_divergence":
-            similarities = self.kl_divergence(embeddings_a, embeddings_b)
+            similarity = self.kl_divergence
         elif self.method == "pearson_correlation":
-            similarities = self.pearson_correlation(embeddings_a, embeddings_b)
+            similarity = self.pearson_correlation
         else:
             raise ValueError(f"Unknown similarity method: {self.method}")
 
+        similarities = torch.cat([similarity(block, embeddings_b)
+                                  for block in torch.split(embeddings_a, self.block_size)])
         return self.postprocess(similarities)
 
     @staticmethod
@@ -48,13 +55,14 @@ class CustomSimilarity:
 
     @staticmethod
     def jaccard_similarity(embeddings_a, embeddings_b):
-        embeddings_a = embeddings_a > 0
-        embeddings_b = embeddings_b > 0
+        # Jaccard over the sets of positive dimensions
+        embeddings_a = (embeddings_a > 0).float()
+        embeddings_b = (embeddings_b > 0).float()
 
-        intersection = torch.sum(
-            embeddings_a & embeddings_b, dim=-1, keepdim=True)
-        union = torch.sum(embeddings_a | embeddings_b, dim=-1, keepdim=True)
-        return intersection / union
+        intersection = embeddings_a @ embeddings_b.T
+        union = embeddings_a.sum(dim=-1, keepdim=True) + \
+            embeddings_b.sum(dim=-1) - intersection
+        return intersection / union.clamp(min=1)
 
     @staticmethod
     def kl_divergence(embeddings_a, embeddings_b):
@@ -62,27 +70,17 @@ class CustomSimilarity:
         embeddings_a = F.softmax(embeddings_a, dim=-1) + eps
         embeddings_b = F.softmax(embeddings_b, dim=-1) + eps
 
-        embeddings_a_log = embeddings_a.log()
-        embeddings_b_log = embeddings_b.log()
-
-        embeddings_a = embeddings_a.unsqueeze(1)
-        embeddings_a_log = embeddings_a_log.unsqueeze(1)
-
-        embeddings_b = embeddings_b.unsqueeze(0)
-        embeddings_b_log = embeddings_b_log.unsqueeze(0)
-
-        kl_div = (embeddings_a * (embeddings_a_log -
-                  embeddings_b_log)).sum(dim=-1)
+        # KL(a || b) = sum a log a - a . log b, without an (N, M, D) tensor
+        entropy_a = (embeddings_a * embeddings_a.log()).sum(dim=-1, keepdim=True)
+        kl_div = entropy_a - embeddings_a @ embeddings_b.log().T
         return -kl_div
 
     @staticmethod
     def pearson_correlation(embeddings_a, embeddings_b):
-        similarities = []
-        for a in embeddings_a:
-            # Move tensors to CPU first if using GPU
-            sim = [pearsonr(a.numpy(), b.numpy())[0] for b in embeddings_b]
-            similarities.append(sim)
-        return torch.tensor(similarities)
+        # Pearson correlation is the cosine similarity of centered vectors
+        embeddings_a = embeddings_a - embeddings_a.mean(dim=-1, keepdim=True)
+        embeddings_b = embeddings_b - embeddings_b.mean(dim=-1, keepdim=True)
+        return CustomSimilarity.cosine_similarity(embeddings_a, embeddings_b)
 
     # TODO: Make the ordering invariant of the postprocessing method (for now, default to raw)
     def postprocess(self, similarities):
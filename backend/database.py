@@ -1,126 +1,776 @@
 import faiss
-from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_community.vectorstores.faiss import DistanceStrategy
 from langchain_core.documents import Document
 
 from embeddings import TextEmbeddings, AudioEmbeddings, AudioTextEmbeddings
 from embeddings import concat_embeddings, average_embeddings
+from embeddings import MODELS, embed_text_query, normalize_query
+from custom_similarity import CustomSimilarity
 
 from songs import Song
 from songs import MetaSet
+from store import ColumnStore
+from result_cache import ResultCache, filter_key
+from wal import WriteAheadLog
+from metrics import METRICS, TimedLock
+import indexes
+
+import numpy as np
+import torch
 
 import threading
+import time
+import shutil
+import json
 import os
 
 
+# Modalities with their own FAISS index. "mixed" vectors are not stored;
+# they are fused from the audio and text indexes at query time.
+MODALITIES = ('audio', 'text')
+DOC_TYPES = ('audio', 'text', 'mixed')
+# Fraction of tombstoned rows in a store that starts a background compaction
+COMPACT_RATIO = 0.2
+
+
+def fsync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_tree(path: str):
+    """Flush every file under path, then the directories naming them."""
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            fsync_path(os.path.join(root, name))
+        fsync_path(root)
+
+
 class Database():
 
-    def __init__(self, path: str, include_all_embeddings: bool = True):
+    def __init__(self, path: str, include_all_embeddings: bool = True, index_spec: str = None,
+                 checkpoint_interval: int = 1000, vector_dtype: str = None):
+        """Load the store at path or create it.
+
+        index_spec picks the FAISS index ('flat', 'ivf', 'ivfpq', 'hnsw' or a
+        faiss.index_factory string). None keeps the spec the store was saved
+        with; a different spec rebuilds the loaded index.
+
+        Additions and deletions are logged to a write-ahead log and replayed
+        on load; a checkpoint (save_db) is taken every checkpoint_interval
+        songs, or never automatically if it is None.
+
+        Songs are keyed by id: posting a stored id replaces it, and deleted
+        or replaced rows are tombstoned until a compaction drops them, which
+        starts in the background once more than compact_ratio of a store is
+        dead (None: only when compact() is called).
+
+        vector_dtype ('float32', 'float16' or 'int8') is the precision the
+        vectors are stored and scanned at; int8 codes come from a scalar
+        quantizer trained on the store. None keeps the loaded store's
+        precision (float32 for new stores); a different one re-encodes it.
+        """
         self.path = os.path.join('backend/vector_stores', path)
+        os.makedirs(self.path, exist_ok=True)
 
+        # Without text vectors only the audio index is kept
         self.include_all_embeddings = include_all_embeddings
+        self.modalities = MODALITIES if include_all_embeddings else ('audio',)
+        self.checkpoint_interval = checkpoint_interval
+        self.vector_dtype = vector_dtype
+        self.pending = 0
+        self.compact_ratio = COMPACT_RATIO
+        self.compaction = None
+        self.compact_lock = threading.Lock()
 
         self.text_embeddings = TextEmbeddings()
         self.audio_embeddings = AudioEmbeddings()
-        self.audio_text_embeddings = AudioTextEmbeddings()
-        self.lock = threading.Lock()
-
-        if os.path.isdir(self.path):
-            self.db = FAISS.load_local(
-                self.path,
-                self.audio_text_embeddings,
-                normalize_L2=True,
-                distance_strategy=DistanceStrategy.COSINE,
-                allow_dangerous_deserialization=True,
-                relevance_score_fn=self.score_normalizer
-            )
+        # Queries: one-off strings that would only churn the song vector cache
+        self.audio_text_embeddings = AudioTextEmbeddings(cache=None)
+        # Reentrant so save_db can rebuild the index while holding it
+        self.lock = TimedLock(threading.RLock(), 'db_lock_wait', METRICS)
+        self.result_cache = ResultCache()
+
+        self.stores = {}
+        # Set when a pickled langchain store was converted on load
+        self.converted = False
+
+        self.generation = self.load_generation()
+        checkpoint = self.checkpoint_path(self.generation)
+        if os.path.isdir(checkpoint):
+            self.load_stores(checkpoint)
+        elif os.path.isdir(os.path.join(self.path, 'audio')):
+            self.load_stores(self.path)
+        elif os.path.isfile(os.path.join(self.path, 'index.faiss')):
+            self.split_legacy_store()
+            self.built_spec = indexes.DEFAULT_SPEC
+
+        loaded = bool(self.stores)
+        if loaded:
+            self.index_spec = index_spec or self.built_spec
+            print(f'Loaded db from {self.path} with {self.sizes()} entries.')
+        else:
+            # Inner Product. Trained indexes start out flat and are rebuilt
+            # from the ingested vectors on the first save_db.
+            self.index_spec = index_spec or indexes.DEFAULT_SPEC
+            self.built_spec = self.index_spec
+            if indexes.needs_training(self.index_spec, MODELS.dim()):
+                self.built_spec = indexes.DEFAULT_SPEC
+
+            for doc_type in self.modalities:
+                self.stores[doc_type] = self.new_store(
+                    doc_type, self.built_spec)
+
+            print(f'Created db from scratch.')
+
+        self.wal = WriteAheadLog(self.wal_path(self.generation))
+        self.replay_wal()
+
+        if loaded and self.index_spec != self.built_spec:
+            self.rebuild_index(self.index_spec)
+        if loaded and vector_dtype is not None:
+            self.set_vector_dtype(vector_dtype)
+        if self.converted:
+            # Convert once; later opens map the checkpoint instead
+            self.save_db()
 
-            print(
-                f'Loaded db from {self.path} with {self.db.index.ntotal} entries.')
-            return
-
-        # Inner Product
-        index = faiss.IndexFlatIP(
-            len(self.audio_text_embeddings.embed_query("hello world")))
+    def score_normalizer(self, val: float) -> float:
+        return val
 
-        self.db = FAISS(
-            embedding_function=self.audio_text_embeddings,
-            index=index,
-            docstore=InMemoryDocstore(),
+    def new_store(self, doc_type: str, index_spec: str) -> ColumnStore:
+        store = ColumnStore(doc_type, MODELS.dim(),
+                            self.vector_dtype or 'float32')
+        # Trained indexes have nothing to train on yet; save_db builds them
+        if indexes.factory_string(index_spec, 0) != 'Flat' \
+                and not indexes.needs_training(index_spec, MODELS.dim()):
+            store.index = faiss.index_factory(
+                MODELS.dim(), indexes.factory_string(index_spec, 0), faiss.METRIC_INNER_PRODUCT)
+        return store
+
+    def set_vector_dtype(self, vector_dtype: str, rangestat: str = 'minmax'):
+        """Re-encode every store's vectors; written out by the next save_db."""
+        with self.lock:
+            for store in self.stores.values():
+                if store.vector_dtype != vector_dtype:
+                    store.set_vector_dtype(vector_dtype, rangestat)
+                    print(f'Converted {store.doc_type} vectors to {vector_dtype}.')
+            self.vector_dtype = vector_dtype
+            self.result_cache.clear()
+
+    def load_langchain_store(self, path: str) -> FAISS:
+        """Open a store pickled by langchain's FAISS.save_local (older layouts)."""
+        db = FAISS.load_local(
+            path,
+            self.audio_text_embeddings,
             normalize_L2=True,
-            index_to_docstore_id={},
             distance_strategy=DistanceStrategy.COSINE,
+            allow_dangerous_deserialization=True,
             relevance_score_fn=self.score_normalizer
         )
-
-        print(f'Created db from scratch.')
-
-    def score_normalizer(self, val: float) -> float:
-        return val
+        indexes.enable_reconstruct(db.index)
+        return db
+
+    def convert_langchain_store(self, doc_type: str, db: FAISS, rows: list[int] = None) -> ColumnStore:
+        """Copy the given rows (default all) of a langchain store into a ColumnStore."""
+        if rows is None:
+            rows = sorted(db.index_to_docstore_id)
+        vectors = indexes.get_vectors(db.index)
+        docs = [db.docstore.search(db.index_to_docstore_id[i]) for i in rows]
+
+        store = self.new_store(doc_type, indexes.DEFAULT_SPEC)
+        store.add([doc.page_content for doc in docs], vectors[rows],
+                  [doc.metadata for doc in docs], [db.index_to_docstore_id[i] for i in rows])
+        self.converted = True
+        return store
+
+    def load_stores(self, path: str):
+        self.built_spec = self.load_index_spec(path)
+        for doc_type in self.modalities:
+            store_path = os.path.join(path, doc_type)
+            if os.path.isfile(os.path.join(store_path, 'meta.json')):
+                self.stores[doc_type] = ColumnStore.open(store_path)
+            elif os.path.isfile(os.path.join(store_path, 'index.pkl')):
+                self.stores[doc_type] = self.convert_langchain_store(
+                    doc_type, self.load_langchain_store(store_path))
+                self.built_spec = indexes.DEFAULT_SPEC
+            else:
+                self.stores[doc_type] = self.new_store(
+                    doc_type, self.built_spec)
+
+    def replay_wal(self):
+        """Re-apply changes logged after the last checkpoint."""
+        songs = 0
+        for op, doc_type, titles, embeddings, metadatas, ids in self.wal.replay():
+            store = self.stores.get(doc_type)
+            if store is None:
+                continue
+            if op == 'delete':
+                store.delete(ids)
+            elif op == 'upsert':
+                store.upsert(titles, embeddings, metadatas, ids)
+            else:
+                store.add(titles, embeddings, metadatas, ids)
+            songs += len(ids)
+        if songs:
+            self.pending = songs
+            print(f'Replayed {songs} entries from {self.wal.path}.')
+
+    def split_legacy_store(self):
+        """Split a single-index store (audio, text and mixed rows) per modality."""
+        legacy = self.load_langchain_store(self.path)
+
+        rows = {doc_type: [] for doc_type in self.modalities}
+        for i, doc_id in legacy.index_to_docstore_id.items():
+            doc_type = legacy.docstore.search(doc_id).metadata['doc_type']
+            if doc_type in rows:
+                rows[doc_type].append(i)
+
+        for doc_type, doc_rows in rows.items():
+            self.stores[doc_type] = self.convert_langchain_store(
+                doc_type, legacy, doc_rows)
+
+        print(f'Split legacy db at {self.path} into {self.sizes()}.')
+
+    def sizes(self) -> dict:
+        return {doc_type: store.ntotal for doc_type, store in self.stores.items()}
 
     def post_songs(self, songs: list[Song]) -> list[str]:
-        """Add a song to the FAISS database."""
-        files = [song.path for song in songs]
-        titles = [song.title for song in songs]
+        """Add songs to the FAISS database, replacing any stored under their ids."""
+        METRICS.count('songs_posted', len(songs))
+        with METRICS.timer('post_songs'):
+            return self.add_songs(songs, *self.embed_songs(songs))
+
+    def embed_songs(self, songs: list[Song]) -> tuple[list, list]:
+        """Audio and text embeddings for songs, computed without the lock."""
+        with METRICS.timer('audio_embedding'):
+            audio_embeddings = self.audio_embeddings.embed_documents(
+                [song.path for song in songs])
+        text_embeddings = []
+        if self.include_all_embeddings:
+            with METRICS.timer('text_embedding'):
+                text_embeddings = self.text_embeddings.embed_documents(
+                    [song.title for song in songs])
+        return audio_embeddings, text_embeddings
+
+    def add_songs(self, songs: list[Song], audio_embeddings: list, text_embeddings: list) -> list[str]:
+        """Upsert songs with precomputed embeddings (see embed_songs).
+
+        A song whose id is already stored replaces it, so posting the same
+        songs again leaves one live row per id; within songs the last copy
+        of an id wins. Empty text_embeddings index the songs audio-only,
+        tombstoning any text rows they had.
+        """
         metadatas = [song.get_metadata() for song in songs]
+        last = {metadata['id']: i for i, metadata in enumerate(metadatas)}
+        if len(last) < len(songs):
+            keep = sorted(last.values())
+            songs = [songs[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            audio_embeddings = [audio_embeddings[i] for i in keep]
+            if text_embeddings:
+                text_embeddings = [text_embeddings[i] for i in keep]
+        titles = [song.title for song in songs]
 
         audio_metadatas = [{**metadata, "doc_type": "audio"}
                            for metadata in metadatas]
         text_metadatas = [{**metadata, "doc_type": "text"}
                           for metadata in metadatas]
-        mixed_metadatas = [{**metadata, "doc_type": "mixed"}
-                           for metadata in metadatas]
-
-        audio_embeddings = self.audio_embeddings.embed_documents(files)
-        text_embeddings = self.text_embeddings.embed_documents(titles)
-        mixed_embeddings = average_embeddings(
-            audio_embeddings, text_embeddings)
 
         audio_ids = ["audio_" + metadata['id'] for metadata in metadatas]
         text_ids = ["text_" + metadata['id'] for metadata in metadatas]
-        mix_ids = ["mixed_" + metadata['id'] for metadata in metadatas]
         ids = []
 
         with self.lock:
             try:
                 # Audio
-                ids.extend(self.db.add_embeddings(
-                    zip(titles, audio_embeddings), audio_metadatas, audio_ids))
+                ids.extend(self.log_and_upsert(
+                    'audio', titles, audio_embeddings, audio_metadatas, audio_ids))
 
-                if self.include_all_embeddings:
+                if self.include_all_embeddings and text_embeddings:
                     # Text
-                    ids.extend(self.db.add_embeddings(
-                        zip(titles, text_embeddings), text_metadatas, text_ids))
-
-                    # Mixed
-                    ids.extend(self.db.add_embeddings(
-                        zip(titles, mixed_embeddings), mixed_metadatas, mix_ids))
+                    ids.extend(self.log_and_upsert(
+                        'text', titles, text_embeddings, text_metadatas, text_ids))
+                elif self.include_all_embeddings:
+                    # A re-indexed song must not keep its old text vector
+                    self.log_and_delete('text', [metadata['id'] for metadata in metadatas])
 
                 print(
-                    f'Uploaded {len(audio_ids)} songs to database. Size is now {self.db.index.ntotal}')
-            except Exception as e:
-                print(e)
-
-        return ids
+                    f'Uploaded {len(audio_ids)} songs to database. Size is now {self.sizes()}')
+            finally:
+                self.result_cache.clear()
 
-    def get_playlist(self, title: str, k: int = 3, filter: dict = None) -> list[tuple[Document, float]]:
-        """Retrieve k-nearest songs from FAISS database."""
-        print(f"Filtering by {filter}")
-        songs_and_scores = self.db.similarity_search_with_relevance_scores(
-            title, k, fetch_k=self.db.index.ntotal, filter=filter)
+            self.pending += len(songs)
+            self.after_write()
 
-        print(
-            f'Retrieved playlist of name {title} of size {len(songs_and_scores)}.')
-
-        return songs_and_scores
-
-    def save_db(self):
-        """Save the FAISS database to the specified path."""
+        return ids
 
-        self.db.save_local(self.path)
+    def log_and_upsert(self, doc_type: str, titles: list[str], embeddings: list[list[float]],
+                       metadatas: list[dict], ids: list[str]) -> list[str]:
+        if not ids:
+            return []
+        self.wal.append(doc_type, titles, embeddings,
+                        metadatas, ids, op='upsert')
+        return self.stores[doc_type].upsert(titles, embeddings, metadatas, ids)
+
+    def log_and_delete(self, doc_type: str, ids: list[str]) -> int:
+        store = self.stores[doc_type]
+        stored = [id for id in ids if id in store.rows]
+        if not stored:
+            return 0
+        self.wal.delete(doc_type, stored)
+        return store.delete(stored)
+
+    def delete_songs(self, ids: list[str]) -> int:
+        """Tombstone songs by id in every modality; returns how many were stored.
+
+        Searches skip them at once; their vectors stay in the index until
+        the next compaction.
+        """
+        with self.lock:
+            deleted = 0
+            try:
+                for doc_type in self.stores:
+                    count = self.log_and_delete(doc_type, ids)
+                    if doc_type == 'audio':
+                        deleted = count
+            finally:
+                self.result_cache.clear()
+
+            print(f'Deleted {deleted} songs from database.')
+            self.pending += deleted
+            self.after_write()
+        return deleted
+
+    def after_write(self):
+        """Checkpoint or compact once enough has changed."""
+        if self.checkpoint_interval and self.pending >= self.checkpoint_interval:
+            self.save_db()
+        if self.compact_ratio is not None and any(
+                len(store.dead) > self.compact_ratio * store.ntotal for store in self.stores.values()):
+            self.compact()
+
+    def compact(self, background: bool = True) -> threading.Thread:
+        """Drop tombstoned rows, rebuilding each index without them.
+
+        The live vectors are copied under the lock, but the new index is
+        trained and filled outside it, so queries and posts carry on; rows
+        posted meanwhile are added to it, and rows deleted meanwhile stay
+        tombstoned. The result is written as a new checkpoint. In the
+        background, returns the compaction thread (an already running one
+        if there is one).
+        """
+        if background:
+            with self.lock:
+                if self.compaction is None or not self.compaction.is_alive():
+                    self.compaction = threading.Thread(
+                        target=self.compact, args=(False,), daemon=True)
+                    self.compaction.start()
+                return self.compaction
+
+        with self.compact_lock:
+            with self.lock:
+                # Searches still holding the old stores may outlive their
+                # checkpoint's files; everything else they read is mapped
+                for store in self.stores.values():
+                    store.index
+                index_spec = self.built_spec
+                snapshot = {doc_type: (store.ntotal, store.live_rows())
+                            for doc_type, store in self.stores.items() if store.dead}
+                vectors = {doc_type: self.stores[doc_type].vectors_at(live)
+                           for doc_type, (_, live) in snapshot.items()}
+            if not snapshot:
+                return None
+
+            start = time.perf_counter()
+            with METRICS.timer('compaction'):
+                built = {doc_type: self.build_index(index_spec, doc_vectors)
+                         for doc_type, doc_vectors in vectors.items()}
+
+                with self.lock:
+                    if (self.built_spec, self.index_spec) != (index_spec, index_spec):
+                        print('Index rebuilt during compaction; not compacting.')
+                        return None
+                    compact, dropped = {}, {}
+                    for doc_type, (ntotal, live) in snapshot.items():
+                        store, index = self.stores[doc_type], built[doc_type]
+                        added = np.arange(ntotal, store.ntotal, dtype=np.int64)
+                        if index is not None and len(added):
+                            index.add(store.vectors_at(added))
+                        compact[doc_type] = (np.concatenate([live, added]), index)
+                        dropped[doc_type] = ntotal - len(live)
+                    self.save_db(compact)
+
+        print(f'Compacted away {dropped} dead rows in {time.perf_counter() - start:.1f}s.')
+        return None
+
+    def get_playlist(self, title: str, k: int = 3, filter: dict = None,
+                     nprobe: int = None, ef_search: int = None, rerank: str = None,
+                     fetch_k: int = None) -> list[tuple[Document, float]]:
+        """Retrieve k-nearest songs from FAISS database.
+
+        A doc_type in the filter sends the query to that modality's index
+        only; without one, every modality is searched and the results merged.
+        nprobe (IVF indexes) and ef_search (HNSW indexes) trade recall for
+        speed; None uses the index defaults. Results are cached for a short
+        TTL and dropped whenever songs are posted.
+
+        rerank names a CustomSimilarity method ('euclidean_distance',
+        'kl_divergence', 'pearson_correlation', ...). FAISS then fetches
+        fetch_k candidates (default max(4k, 20)) and the top k by that
+        method over their stored vectors are returned, scored by it.
+        """
+        with METRICS.trace('get_playlist', title=title, k=k, filter=filter_key(filter), rerank=rerank):
+            print(f"Filtering by {filter}")
+            with METRICS.timer('query_embedding'):
+                query = np.array(
+                    [self.audio_text_embeddings.embed_query(title)], dtype=np.float32)
+
+            key = (query.tobytes(), k, filter_key(filter), nprobe, ef_search, rerank, fetch_k)
+            songs_and_scores = self.result_cache.get(key)
+            METRICS.count('result_cache_misses' if songs_and_scores is None
+                          else 'result_cache_hits')
+            if songs_and_scores is None and rerank is None:
+                songs_and_scores = self.search(
+                    query, k, filter, nprobe=nprobe, ef_search=ef_search)[0]
+                self.result_cache.put(key, songs_and_scores)
+            elif songs_and_scores is None:
+                fetch_k = fetch_k or max(4 * k, 20)
+                start = time.perf_counter()
+                candidates = self.search(
+                    query, fetch_k, filter, nprobe=nprobe, ef_search=ef_search)[0]
+                fetched = time.perf_counter()
+                with METRICS.timer('rerank'):
+                    songs_and_scores = self.rerank(query[0], candidates, rerank, k)
+                reranked = time.perf_counter()
+                print(f'Fetched {len(candidates)} candidates in {(fetched - start) * 1000:.1f} ms, '
+                      f're-ranked by {rerank} in {(reranked - fetched) * 1000:.1f} ms.')
+                self.result_cache.put(key, songs_and_scores)
 
-        print(f'Saved db to {self.path}.')
+            print(
+                f'Retrieved playlist of name {title} of size {len(songs_and_scores)}.')
+
+            return songs_and_scores
+
+    def get_playlists(self, titles: list[str], k: int = 3, filters=None,
+                      nprobe: int = None, ef_search: int = None) -> list[list[tuple[Document, float]]]:
+        """Retrieve k-nearest songs for many titles at once.
+
+        filters is one filter for every title or a list with one per title.
+        All titles are embedded in one batch, and queries sharing a filter
+        are answered by a single FAISS search over their query matrix with
+        the filter's candidate rows computed once.
+        """
+        if filters is None or isinstance(filters, dict):
+            filters = [filters] * len(titles)
+
+        with METRICS.timer('query_embedding'):
+            embeddings = self.audio_text_embeddings.embed_documents(
+                [title if title.lower().strip().endswith('.mp3') else normalize_query(title)
+                 for title in titles])
+
+        groups = {}
+        for i, (embedding, filter) in enumerate(zip(embeddings, filters)):
+            if embedding is not None:
+                groups.setdefault(filter_key(filter), (filter, []))[1].append(i)
+
+        playlists = [[] for _ in titles]
+        for filter, positions in groups.values():
+            queries = np.array([embeddings[i]
+                               for i in positions], dtype=np.float32)
+            for i, songs_and_scores in zip(positions, self.search(
+                    queries, k, filter, nprobe=nprobe, ef_search=ef_search)):
+                playlists[i] = songs_and_scores
+
+        print(f'Retrieved {len(titles)} playlists of size {k}.')
+        return playlists
+
+    def search(self, queries: np.ndarray, k: int, filter: dict = None,
+               nprobe: int = None, ef_search: int = None) -> list[list[tuple[Document, float]]]:
+        """Score only the vectors whose metadata matches the filter, per query row.
+
+        The stores are looked up once, so a compaction swapping in
+        renumbered stores meanwhile never mixes old and new rows.
+        """
+        METRICS.count('queries', len(queries))
+        stores = dict(self.stores)
+        faiss.normalize_L2(queries)
+
+        filter = dict(filter or {})
+        doc_type = filter.pop('doc_type', None)
+        if doc_type is not None:
+            doc_types = [doc_type] if isinstance(doc_type, str) else list(doc_type)
+        else:
+            doc_types = list(self.modalities)
+            if 'text' in stores:
+                doc_types.append('mixed')
+
+        results = [[] for _ in queries]
+        for doc_type in doc_types:
+            if doc_type == 'mixed':
+                found = self.search_mixed(
+                    stores, queries, k, filter, nprobe=nprobe, ef_search=ef_search)
+            elif doc_type in stores:
+                found = self.search_modality(
+                    stores[doc_type], queries, k, filter, nprobe=nprobe, ef_search=ef_search)
+            else:
+                continue
+            for songs_and_scores, more in zip(results, found):
+                songs_and_scores.extend(more)
+
+        for songs_and_scores in results:
+            songs_and_scores.sort(
+                key=lambda song_and_score: -song_and_score[1])
+            del songs_and_scores[k:]
+        return results
+
+    def rerank(self, query: np.ndarray, songs_and_scores: list[tuple[Document, float]],
+               method: str, k: int) -> list[tuple[Document, float]]:
+        """Reorder search results by a CustomSimilarity method on their stored vectors."""
+        if not songs_and_scores:
+            return []
+
+        docs = [doc for doc, _ in songs_and_scores]
+        vectors = np.array([self.stored_vector(doc) for doc in docs], dtype=np.float32)
+        scores = CustomSimilarity(method).compute_similarity(
+            torch.from_numpy(query[None, :]), torch.from_numpy(vectors))[0]
+
+        order = torch.argsort(scores, descending=True)[:k]
+        return [(docs[j], float(scores[j])) for j in order.tolist()]
+
+    def stored_vector(self, doc: Document) -> np.ndarray:
+        """The indexed vector behind a search result, fused for "mixed" songs."""
+        id, doc_type = doc.metadata['id'], doc.metadata['doc_type']
+        if doc_type == 'mixed':
+            return average_embeddings(self.stored_vector_of('audio', id),
+                                      self.stored_vector_of('text', id))
+        return self.stored_vector_of(doc_type, id)
+
+    def stored_vector_of(self, doc_type: str, id: str) -> np.ndarray:
+        store = self.stores[doc_type]
+        return store.vectors_at([store.rows[id]])[0]
+
+    def cache_stats(self) -> dict:
+        """Hit/miss counters for the query-embedding and result caches."""
+        query_info = embed_text_query.cache_info()
+        return {'query_embeddings': {'hits': query_info.hits, 'misses': query_info.misses,
+                                     'size': query_info.currsize},
+                'results': self.result_cache.stats()}
+
+    def candidates(self, store: ColumnStore, filter: dict) -> np.ndarray:
+        """Rows of a modality's index matching the filter."""
+        with METRICS.timer('filter'):
+            return self.matching_rows(store, filter)
+
+    def matching_rows(self, store: ColumnStore, filter: dict) -> np.ndarray:
+        indexed = {field: value for field, value in filter.items()
+                   if store.metadata_index.supports({field: value})}
+        unindexed = {field: value for field, value in filter.items()
+                     if field not in indexed}
+        candidates = store.metadata_index.resolve(indexed)
+        if not unindexed:
+            return candidates
+
+        # Fields outside the metadata index are checked on the documents
+        return np.array([i for i in candidates
+                         if all(store.metadata(i).get(field) == value
+                                for field, value in unindexed.items())], dtype=np.int64)
+
+    def search_rows(self, store: ColumnStore, queries: np.ndarray, k: int, filter: dict = None,
+                    nprobe: int = None, ef_search: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """Batched FAISS search of one modality; rows are -1 past the matches.
+
+        Tombstoned rows are excluded through the same ID selector as the
+        filter's candidates.
+        """
+        dead = store.dead_rows
+        selector = None
+        if filter:
+            candidates = self.candidates(store, filter)
+            if len(dead):
+                candidates = np.setdiff1d(candidates, dead, assume_unique=True)
+            if len(candidates) == 0:
+                return (np.zeros((len(queries), 0), dtype=np.float32),
+                        np.zeros((len(queries), 0), dtype=np.int64))
+            selector = faiss.IDSelectorBatch(
+                len(candidates), faiss.swig_ptr(candidates))
+        elif len(dead):
+            # The inner selector must outlive the search
+            dead_selector = faiss.IDSelectorBatch(len(dead), faiss.swig_ptr(dead))
+            selector = faiss.IDSelectorNot(dead_selector)
+        params = indexes.search_params(
+            store.index, selector, nprobe=nprobe, ef_search=ef_search)
+
+        with METRICS.timer('faiss_search'):
+            return store.index.search(queries, k, params=params)
+
+    def search_modality(self, store: ColumnStore, queries: np.ndarray, k: int, filter: dict = None,
+                        nprobe: int = None, ef_search: int = None) -> list[list[tuple[Document, float]]]:
+        scores, rows = self.search_rows(
+            store, queries, k, filter, nprobe=nprobe, ef_search=ef_search)
+
+        return [[(store.document(i), self.score_normalizer(float(score)))
+                 for score, i in zip(query_scores, query_rows) if i != -1]
+                for query_scores, query_rows in zip(scores, rows)]
+
+    def search_mixed(self, stores: dict, queries: np.ndarray, k: int, filter: dict = None, fetch_k: int = None,
+                     nprobe: int = None, ef_search: int = None) -> list[list[tuple[Document, float]]]:
+        """Fuse audio and text scores into the "mixed" ranking at query time.
+
+        Candidates are the top fetch_k of each modality; each is rescored
+        against the normalized average of its audio and text vectors, which
+        is exactly what the old precomputed mixed vectors stored.
+        """
+        if 'text' not in stores:
+            return [[] for _ in queries]
+
+        fetch_k = fetch_k or max(4 * k, 20)
+        audio, text = stores['audio'], stores['text']
+        audio_rows = audio.rows
+        text_rows = text.rows
+
+        # Candidate song ids per query from both modalities
+        candidates = [set() for _ in queries]
+        for store in (audio, text):
+            _, rows = self.search_rows(store, queries, fetch_k, filter,
+                                       nprobe=nprobe, ef_search=ef_search)
+            for ids, query_rows in zip(candidates, rows):
+                ids.update(store.metadata(i)['id']
+                           for i in query_rows if i != -1)
+
+        with METRICS.timer('mixed_fusion'):
+            results = []
+            for query, ids in zip(queries, candidates):
+                ids = [id for id in ids if id in audio_rows and id in text_rows]
+                if not ids:
+                    results.append([])
+                    continue
+
+                audio_vectors = audio.vectors_at([audio_rows[id] for id in ids])
+                text_vectors = text.vectors_at([text_rows[id] for id in ids])
+                mixed = np.array([average_embeddings(a, t) for a, t in zip(audio_vectors, text_vectors)],
+                                 dtype=np.float32)
+                scores = mixed @ query
+
+                songs_and_scores = []
+                for j in np.argsort(-scores)[:k]:
+                    doc = audio.document(audio_rows[ids[j]])
+                    doc.metadata['doc_type'] = 'mixed'
+                    songs_and_scores.append(
+                        (doc, self.score_normalizer(float(scores[j]))))
+                results.append(songs_and_scores)
+        return results
+
+    def build_index(self, index_spec: str, vectors: np.ndarray) -> faiss.Index:
+        """Index of the given spec over vectors, or None for a flat one."""
+        if indexes.factory_string(index_spec, 0) == 'Flat' or not len(vectors):
+            return None
+        index = indexes.build_index(index_spec, vectors)
+        return None if isinstance(index, faiss.IndexFlat) else index
+
+    def rebuild_index(self, index_spec: str, doc_types: list[str] = None):
+        """Train an index of the given spec on the stored vectors and swap it in.
+
+        Only the stores of doc_types are rebuilt (default all). Stores too
+        small to train on stay flat until a later save_db. Training runs
+        under the lock and is the slow part of a save: about 0.2s for 'ivf'
+        and 4s for 'ivfpq' on 3000 tracks.
+        """
+        with self.lock:
+            for doc_type in doc_types or list(self.stores):
+                store = self.stores[doc_type]
+                store.index = self.build_index(index_spec, store.all_vectors())
+            self.index_spec = self.built_spec = index_spec
+
+        print(f'Rebuilt indexes as {index_spec}.')
+
+    def recall_report(self, specs: list[str], k: int = 10, n_queries: int = 100,
+                      doc_type: str = 'audio') -> list[dict]:
+        """Measure recall@k and latency of ANN specs against exact search."""
+        rows = indexes.recall_report(
+            self.stores[doc_type].all_vectors(), specs, k, n_queries)
+        indexes.print_report(rows)
+        return rows
+
+    def load_index_spec(self, path: str) -> str:
+        spec_path = os.path.join(path, 'index.json')
+        if not os.path.isfile(spec_path):
+            return indexes.DEFAULT_SPEC
+        with open(spec_path) as fp:
+            return json.load(fp)['index_spec']
+
+    def load_generation(self) -> int:
+        current = os.path.join(self.path, 'CURRENT')
+        if not os.path.isfile(current):
+            return 0
+        with open(current) as fp:
+            return int(fp.read())
+
+    def checkpoint_path(self, generation: int) -> str:
+        return os.path.join(self.path, f'checkpoint-{generation}')
+
+    def wal_path(self, generation: int) -> str:
+        return os.path.join(self.path, f'wal-{generation}.log')
+
+    def save_db(self, compact: dict = None):
+        """Checkpoint the FAISS database to the specified path.
+
+        The stores are written to a fresh checkpoint directory that becomes
+        live when the CURRENT file is atomically replaced; only then are the
+        previous checkpoint and its write-ahead log removed. Every file of
+        the checkpoint and its directories are fsynced before the switch.
+        The stores are then memory-mapped from the new checkpoint.
+
+        compact maps a doc_type to the (rows, index) its store keeps (see
+        ColumnStore.save); compact() builds it.
+
+        A trained index_spec is trained here first when it changed or a
+        store still has none (see rebuild_index).
+        """
+        with self.lock:
+            if self.index_spec != self.built_spec:
+                self.rebuild_index(self.index_spec)
+            elif indexes.needs_training(self.index_spec, MODELS.dim()):
+                # Trained stores that were empty or too small last time
+                untrained = [doc_type for doc_type, store in self.stores.items()
+                             if store.ntotal and store.flat]
+                if untrained:
+                    self.rebuild_index(self.index_spec, untrained)
+
+            generation = self.generation + 1
+            checkpoint = self.checkpoint_path(generation)
+            # Left over from a crash before CURRENT was switched
+            shutil.rmtree(checkpoint, ignore_errors=True)
+
+            for doc_type, store in list(self.stores.items()):
+                self.stores[doc_type] = store.save(os.path.join(checkpoint, doc_type), self.index_spec,
+                                                   *(compact or {}).get(doc_type, ()))
+            with open(os.path.join(checkpoint, 'index.json'), 'w') as fp:
+                json.dump({'index_spec': self.index_spec}, fp)
+            # CURRENT must never point at files that are not on disk yet
+            fsync_tree(checkpoint)
+
+            current = os.path.join(self.path, 'CURRENT')
+            with open(current + '.tmp', 'w') as fp:
+                fp.write(str(generation))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(current + '.tmp', current)
+            # The checkpoint's entry and the switch are durable before the
+            # WAL they supersede is removed
+            fsync_path(self.path)
+
+            self.wal.remove()
+            shutil.rmtree(self.checkpoint_path(
+                self.generation), ignore_errors=True)
+            self.generation = generation
+            self.wal = WriteAheadLog(self.wal_path(generation))
+            self.pending = 0
+
+        print(f'Saved db to {checkpoint}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+from concurrent.futures import Future
+import numpy as np
+import threading
+import select
+import ctypes
+import struct
+import time
+import os
+
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify():
+    """Minimal inotify binding: file names finalized in watched directories."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.lock = threading.Lock()
+        self.directories = {}
+
+    def watch(self, directory: str):
+        with self.lock:
+            if directory in self.directories.values():
+                return
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'Cannot watch {directory}')
+            self.directories[wd] = directory
+
+    def read(self, timeout: float) -> list[tuple[str, str]]:
+        """(directory, name) of files finalized within timeout seconds."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset +
+                        EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            with self.lock:
+                if mask & IN_IGNORED:
+                    # The directory was removed; watch it afresh if it returns
+                    self.directories.pop(wd, None)
+                elif wd in self.directories and name:
+                    events.append((self.directories[wd], os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Download():
+    """A pending expect(): where to look, and when it was asked for."""
+    __slots__ = ('directory', 'prefix', 'future', 'since', 'started', 'deadline')
+
+    def __init__(self, directory: str, prefix: str, since: float, timeout: float):
+        self.directory = directory
+        self.prefix = prefix
+        self.future = Future()
+        self.since = since
+        self.started = time.perf_counter()
+        self.deadline = self.started + timeout
+
+    def matches(self, directory: str, name: str) -> bool:
+        if directory != self.directory or not name.startswith(self.prefix):
+            return False
+        try:
+            return os.path.getmtime(os.path.join(directory, name)) >= self.since
+        except FileNotFoundError:
+            return False
+
+
+class DownloadTracker():
+    """One watcher thread that resolves a future per expected download.
+
+    expect() returns a future for the first new file in a directory whose
+    name starts with the prefix and no longer ends with the browser's
+    partial suffix; it resolves to (path, seconds since expect) as soon as
+    the file is renamed or closed, or fails with TimeoutError. Events come
+    from inotify on Linux; elsewhere the watched directories are rescanned
+    every poll_interval seconds, once for all pending downloads.
+    """
+
+    def __init__(self, suffix: str = '.crdownload', poll_interval: float = 0.25):
+        self.suffix = suffix
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.latencies = []
+        self.timeouts = 0
+        self.stopped = threading.Event()
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError):
+            self.inotify = None
+
+        self.watcher = threading.Thread(target=self.watch_loop, daemon=True)
+        self.watcher.start()
+
+    def expect(self, directory: str, prefix: str, timeout: float = 30,
+               since: float = None) -> Future:
+        """Future for the next download into directory named prefix*.
+
+        Files already finished at or after since (a time.time(), default
+        now) also count, in case the download won the race with this call.
+        """
+        download = Download(os.path.abspath(directory), prefix,
+                            time.time() if since is None else since, timeout)
+        with self.lock:
+            if self.inotify is not None:
+                self.inotify.watch(download.directory)
+            self.pending.append(download)
+
+        for name in os.listdir(download.directory):
+            self.finished(download.directory, name)
+        return download.future
+
+    def finished(self, directory: str, name: str):
+        if name.endswith(self.suffix):
+            return
+        with self.lock:
+            for download in self.pending:
+                if download.matches(directory, name):
+                    self.pending.remove(download)
+                    break
+            else:
+                return
+            seconds = time.perf_counter() - download.started
+            self.latencies.append(seconds)
+        download.future.set_result((os.path.join(directory, name), seconds))
+
+    def watch_loop(self):
+        while not self.stopped.is_set():
+            if self.inotify is not None:
+                for directory, name in self.inotify.read(self.poll_interval):
+                    self.finished(directory, name)
+            else:
+                self.stopped.wait(self.poll_interval)
+                with self.lock:
+                    directories = {download.directory for download in self.pending}
+                for directory in directories:
+                    for name in os.listdir(directory):
+                        self.finished(directory, name)
+            self.expire()
+
+    def expire(self):
+        now = time.perf_counter()
+        with self.lock:
+            expired = [download for download in self.pending
+                       if download.deadline <= now]
+            for download in expired:
+                self.pending.remove(download)
+            self.timeouts += len(expired)
+        for download in expired:
+            download.future.set_exception(TimeoutError(
+                f'No download of {download.prefix} in {download.directory}'))
+
+    def close(self):
+        self.stopped.set()
+        self.watcher.join()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def report(self) -> dict:
+        """Print and return per-track download latency percentiles."""
+        with self.lock:
+            latencies = np.array(self.latencies)
+        report = {'downloads': len(latencies), 'timeouts': self.timeouts}
+        if len(latencies):
+            report.update({f'p{q}_sec': float(np.percentile(latencies, q))
+                           for q in (50, 95, 99)})
+            report['max_sec'] = float(latencies.max())
+        print(f"Downloaded {report['downloads']} tracks ({report['timeouts']} timed out)"
+              + ''.join(f", {key} {value:.2f}" for key, value in report.items() if key.endswith('_sec')))
+        return report
@@ -1,17 +1,297 @@
 import numpy as np
 from msclap import CLAP
 from langchain_core.embeddings.embeddings import Embeddings
+from contextlib import contextmanager
+from functools import lru_cache
+import threading
+import hashlib
+import time
+import torch
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: msvcrt only has exclusive locks
+    fcntl = None
+    import msvcrt
+
+from audio_stream import load_windows, slice_windows, random_clip
+from feature_store import FeatureStore, track_id
+
+
+CLAP_VERSION = '2023'
+CLAP_DIMS = {'2022': 1024, '2023': 1024}
+TOWERS = ('text', 'audio')
+BATCH_SIZE = 32
+CACHE_DIR = 'backend/embedding_cache'
+CACHE_ENTRIES = 16384
+# SHA-256 digest of a cache key
+KEY_BYTES = 32
+QUERY_CACHE_SIZE = 1024
+WINDOW_DIR = 'backend/embedding_cache/windows'
+MAX_BATCH_WINDOWS = 64
+
+
+class ModelRegistry():
+    """Process-wide cache of CLAP models, loaded lazily on first use.
+
+    `towers` limits which encoders stay resident: a process that only embeds
+    queries can call `configure(towers={'text'})` before the first lookup and
+    the audio encoder is dropped right after loading (and vice versa).
+    """
+
+    def __init__(self, version: str = CLAP_VERSION, use_cuda: bool = False, towers=TOWERS):
+        self.lock = threading.Lock()
+        self.models = {}
+        # Called whenever the model that serves lookups may change
+        self.listeners = []
+        self.configure(version, use_cuda, towers)
+
+    def configure(self, version: str = CLAP_VERSION, use_cuda: bool = False, towers=TOWERS):
+        towers = frozenset(towers)
+        if not towers or not towers <= set(TOWERS):
+            raise ValueError(f"towers must be a non-empty subset of {TOWERS}")
+        self.version = version
+        self.use_cuda = use_cuda
+        self.towers = towers
+        self.changed()
+
+    def get(self, tower: str) -> CLAP:
+        """Return the shared model, loading it on first call."""
+        if tower not in self.towers:
+            raise ValueError(
+                f"The {tower} tower is not loaded in this process (towers={sorted(self.towers)})")
+
+        key = (self.version, self.use_cuda, self.towers)
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = self._load(*key)
+            return self.models[key]
+
+    def dim(self) -> int:
+        return CLAP_DIMS[self.version]
+
+    def set(self, model):
+        """Serve model for the configured towers instead of loading CLAP."""
+        with self.lock:
+            self.models[(self.version, self.use_cuda, self.towers)] = model
+        self.changed()
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+        self.changed()
+
+    def changed(self):
+        for listener in self.listeners:
+            listener()
+
+    @staticmethod
+    def _load(version, use_cuda, towers) -> CLAP:
+        print(f'Loading CLAP {version} ({", ".join(sorted(towers))})')
+        model = CLAP(version=version, use_cuda=use_cuda)
+        # Free the encoder this process will never call
+        if 'audio' not in towers:
+            model.clap.audio_encoder = None
+        if 'text' not in towers:
+            model.clap.caption_encoder = None
+        return model
+
+
+MODELS = ModelRegistry()
+
+
+class EmbeddingCache():
+    """Persistent embedding cache keyed by content hash and model version.
+
+    Vectors live in one memory-mapped .npy shard of max_entries rows, with
+    each row's key (the raw SHA-256 digest) and last use time in two more
+    mapped columns beside it. The least recently used row is reused once
+    the shard is full. Several processes can share the cache: writes hold
+    an exclusive lock on the directory's lock file and reads a shared one.
+    Every write bumps a shared epoch, and a process rebuilds its key -> row
+    map from the key column only when the epoch moved since it last looked.
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_entries: int = CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.keys = None
+        self.used = None
+        self.epoch = None
+        self.lock_file = None
+        # Digest -> row, valid while the shared epoch equals seen
+        self.slots = {}
+        self.seen = None
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def file_lock(self, shared: bool = False):
+        if fcntl is None:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                self.lock_file.seek(0)
+                msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+
+        fcntl.flock(self.lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def open(self):
+        if self.vectors is not None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self.lock_file = open(os.path.join(self.path, 'lock'), 'a')
+        with self.file_lock():
+            columns = [('vectors.npy', np.float32, (self.max_entries, MODELS.dim())),
+                       ('keys.npy', np.uint8, (self.max_entries, KEY_BYTES)),
+                       ('used.npy', np.int64, (self.max_entries,)),
+                       ('epoch.npy', np.int64, (1,))]
+            mapped = []
+            for name, dtype, shape in columns:
+                path = os.path.join(self.path, name)
+                column = np.load(path, mmap_mode='r+') if os.path.isfile(path) else None
+                if column is None or column.shape != shape or column.dtype != dtype:
+                    column = None
+                mapped.append(column)
+
+            if any(column is None for column in mapped):
+                # New, resized or from an older layout: start empty
+                mapped = [np.lib.format.open_memmap(os.path.join(self.path, name), mode='w+',
+                                                    dtype=dtype, shape=shape)
+                          for name, dtype, shape in columns]
+            self.vectors, self.keys, self.used, self.epoch = mapped
+            self.seen = None
+
+    def refresh(self):
+        """Rebuild the key -> row map if the cache was written since; call
+        with the file lock held."""
+        if self.seen == int(self.epoch[0]):
+            return
+        rows = np.flatnonzero(self.used)
+        self.slots = dict(zip(self.keys[rows].view(f'V{KEY_BYTES}').ravel().tolist(),
+                              rows.tolist()))
+        self.seen = int(self.epoch[0])
+
+    def find(self, key: str) -> int:
+        """Row holding key, or None; call refresh() first."""
+        return self.slots.get(bytes.fromhex(key))
+
+    def get_many(self, keys: list[str]) -> list:
+        """Cached vectors for keys, with None for every miss."""
+        with self.lock:
+            self.open()
+            res = []
+            with self.file_lock(shared=True):
+                self.refresh()
+                now = time.time_ns()
+                for key in keys:
+                    slot = self.find(key)
+                    if slot is None:
+                        res.append(None)
+                    else:
+                        # Racing another reader's touch only blurs the LRU order
+                        self.used[slot] = now
+                        res.append(self.vectors[slot].tolist())
+            hits = sum(vector is not None for vector in res)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            return res
+
+    def put_many(self, keys: list[str], embeddings: list[list[float]]):
+        # More than fit would evict each other
+        keys, embeddings = keys[-self.max_entries:], embeddings[-self.max_entries:]
+        with self.lock:
+            self.open()
+            with self.file_lock():
+                self.refresh()
+                slots = [self.find(key) for key in keys]
+                missing = [i for i, slot in enumerate(slots) if slot is None]
+                if missing:
+                    # Least recently used rows first; empty rows were never used
+                    used = np.array(self.used)
+                    used[[slot for slot in slots if slot is not None]] = np.iinfo(np.int64).max
+                    order = np.argsort(used)[:len(missing)]
+                    for i, slot in zip(missing, order.tolist()):
+                        slots[i] = slot
+
+                # A row's key is cleared while its vector is rewritten, so
+                # a crash in between leaves a miss, never a wrong vector
+                for slot in slots:
+                    self.slots.pop(self.keys[slot].tobytes(), None)
+                self.keys[slots] = 0
+                self.used[slots] = 0
+                self.flush()
+                for slot, embedding in zip(slots, embeddings):
+                    self.vectors[slot] = embedding
+                self.vectors.flush()
+                now = time.time_ns()
+                for key, slot in zip(keys, slots):
+                    self.keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+                    self.used[slot] = now
+                    self.slots[bytes.fromhex(key)] = slot
+                self.epoch[0] += 1
+                self.seen = int(self.epoch[0])
+                self.flush()
+
+    def flush(self):
+        self.keys.flush()
+        self.used.flush()
+        self.epoch.flush()
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f'{MODELS.version}:text:{normalized}'.encode()).hexdigest()
+
+    @staticmethod
+    def file_key(path: str, variant: str = '') -> str:
+        digest = hashlib.sha256(f'{MODELS.version}:audio{variant}:'.encode())
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+def cache_from_env() -> EmbeddingCache:
+    """EmbeddingCache enabled by VIBESYNC_EMBEDDING_CACHE, or None.
+
+    The variable holds the cache's max_entries, so it can be sized to the
+    catalog: the vectors file takes 4KB per entry up front.
+    """
+    entries = os.environ.get('VIBESYNC_EMBEDDING_CACHE')
+    return EmbeddingCache(max_entries=int(entries)) if entries else None
+
+
+# Off unless asked for, so the app and query-only processes map nothing
+CACHE = cache_from_env()
+
 
 class TextEmbeddings(Embeddings):
 
-    def __init__(self):
-        self.model = CLAP(version='2023', use_cuda=False)
+    def __init__(self, batch_size: int = BATCH_SIZE, cache: EmbeddingCache = CACHE):
+        self.batch_size = batch_size
+        self.cache = cache
+
+    @property
+    def model(self) -> CLAP:
+        return MODELS.get('text')
 
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
         # print("Added Text Embedding")
-        return self.model.get_text_embeddings(texts).tolist()
+        return embed_with_cache(self.cache, texts, EmbeddingCache.text_key, lambda texts: embed_in_batches(
+            self.model.get_text_embeddings, texts, self.batch_size))
 
     def embed_query(self, query: str) -> list[float]:
         # print("Added Text Embedding")
@@ -19,13 +299,100 @@ class TextEmbeddings(Embeddings):
 
 
 class AudioEmbeddings(Embeddings):
+    """Embeds audio files with the CLAP audio tower.
+
+    By default CLAP decodes each whole file and embeds one random clip of
+    it. With windows=N, N evenly spaced clips are streamed from the file
+    instead (see audio_stream.load_windows) and their normalized vectors
+    averaged into the track vector; max_batch_windows caps the clips held
+    and encoded at once. keep_windows also writes each track's window
+    vectors to WINDOW_DIR for segment-level search.
+
+    With a FeatureStore, clips of tracks it holds are cut from the stored
+    PCM and only the other files are decoded.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, cache: EmbeddingCache = CACHE,
+                 windows: int = None, max_batch_windows: int = MAX_BATCH_WINDOWS,
+                 keep_windows: bool = False, features: FeatureStore = None):
+        self.batch_size = batch_size
+        self.cache = cache
+        self.windows = windows
+        self.max_batch_windows = max_batch_windows
+        self.keep_windows = keep_windows
+        self.features = features
+
+    @property
+    def model(self) -> CLAP:
+        return MODELS.get('audio')
 
-    def __init__(self):
-        self.model = CLAP(version='2023', use_cuda=False)
+    def key(self, file: str) -> str:
+        """Cache key of a file's vector, distinct per windowing."""
+        return EmbeddingCache.file_key(file, f':windows={self.windows}' if self.windows else '')
 
     def embed_documents(self, files: list[str]) -> list[list[float]]:
         # print("Added Audio Embedding")
-        return self.model.get_audio_embeddings(files, resample=True).tolist()
+        return embed_with_cache(self.cache, files, self.key, lambda files: embed_in_batches(
+            self.embed_audio_batch, files, self.batch_size))
+
+    def embed_audio_batch(self, files: list[str]):
+        if self.windows:
+            return torch.from_numpy(np.stack([self.embed_windows(file).mean(axis=0) for file in files]))
+        if self.features is None:
+            return self.model.get_audio_embeddings(files, resample=True)
+
+        stored = [self.stored_samples(file) for file in files]
+        decode = [file for file, samples in zip(files, stored) if samples is None]
+        decoded = iter(self.model.get_audio_embeddings(decode, resample=True).cpu().numpy()
+                       if decode else [])
+        clips = [random_clip(samples, self.clip_length())
+                 for samples in stored if samples is not None]
+        encoded = iter(self.encode_clips(torch.stack(clips)) if clips else [])
+        return torch.from_numpy(np.stack([next(decoded) if samples is None else next(encoded)
+                                          for samples in stored]))
+
+    def embed_windows(self, file: str) -> np.ndarray:
+        """Normalized (windows, dim) vectors of a file's evenly spaced clips."""
+        samples = self.stored_samples(file)
+        if samples is None:
+            clips = load_windows(file, self.model.args.sampling_rate,
+                                 self.model.args.duration, self.windows)
+        else:
+            clips = slice_windows(samples, self.clip_length(), self.windows)
+
+        vectors = self.encode_clips(clips)
+        vectors /= np.maximum(np.linalg.norm(vectors,
+                              axis=1, keepdims=True), 1e-12)
+
+        if self.keep_windows:
+            os.makedirs(WINDOW_DIR, exist_ok=True)
+            np.save(os.path.join(WINDOW_DIR, self.key(file) + '.npy'), vectors)
+        return vectors
+
+    def clip_length(self) -> int:
+        return int(self.model.args.duration * self.model.args.sampling_rate)
+
+    def stored_samples(self, file: str) -> np.ndarray:
+        if self.features is None or self.features.sample_rate != self.model.args.sampling_rate:
+            return None
+        return self.features.get(track_id(file))
+
+    def encode_clips(self, clips) -> np.ndarray:
+        """Run the audio tower on (n, samples) clips, max_batch_windows at a time."""
+        model = self.model
+        vectors = []
+        for start in range(0, len(clips), self.max_batch_windows):
+            batch = clips[start:start + self.max_batch_windows]
+            if model.use_cuda and torch.cuda.is_available():
+                batch = batch.cuda()
+            vectors.append(model._get_audio_embeddings(
+                batch.unsqueeze(1)).cpu().numpy())
+        return np.concatenate(vectors)
+
+    def window_vectors(self, file: str) -> np.ndarray:
+        """Window vectors kept for file by an earlier keep_windows pass, or None."""
+        path = os.path.join(WINDOW_DIR, self.key(file) + '.npy')
+        return np.load(path) if os.path.isfile(path) else None
 
     def embed_query(self, file: str) -> list[float]:
         # print("Added Audio Embedding")
@@ -33,39 +400,95 @@ class AudioEmbeddings(Embeddings):
 
 
 class AudioTextEmbeddings(Embeddings):
+    """Embeds a mix of titles and .mp3 paths, batching each kind separately.
 
-    def __init__(self):
-        self.model = CLAP(version='2023', use_cuda=False)
+    Results come back in input order; a path that does not exist yields
+    None at its position.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, cache: EmbeddingCache = CACHE):
+        self.text = TextEmbeddings(batch_size, cache)
+        self.audio = AudioEmbeddings(batch_size, cache)
+
+    @property
+    def text_model(self) -> CLAP:
+        return MODELS.get('text')
+
+    @property
+    def audio_model(self) -> CLAP:
+        return MODELS.get('audio')
 
     def embed_documents(self, docs: list[str]) -> list[list[float]]:
-        res = []
-        for doc in docs:
+        res = [None] * len(docs)
+        text_positions, audio_positions = [], []
+        for i, doc in enumerate(docs):
             if not doc.lower().strip().endswith('.mp3'):
-                res.append(self.model.get_text_embeddings([doc])[0])
-                # print("Added Text Embedding")
-                continue
-
-            if not os.path.isfile(doc):
+                text_positions.append(i)
+            elif os.path.isfile(doc):
+                audio_positions.append(i)
+            else:
                 print(f'{doc} does not exists!')
-                continue
 
-            res.append(self.model.get_audio_embeddings(
-                [doc], resample=True)[0])
-            # print("Added Audio Embedding")
+        for positions, embeddings in ((text_positions, self.text), (audio_positions, self.audio)):
+            if not positions:
+                continue
+            for i, embedding in zip(positions, embeddings.embed_documents([docs[i] for i in positions])):
+                res[i] = embedding
 
         return res
 
     def embed_query(self, query: str) -> list[float]:
         if not query.lower().strip().endswith('.mp3'):
             # print("Added Text Embedding")
-            return self.model.get_text_embeddings([query])[0].tolist()
+            return list(embed_text_query(normalize_query(query)))
 
         if not os.path.isfile(query):
             print(f'{query} does not exists!')
             return
 
         # print("Added Audio Embedding")
-        return self.model.get_audio_embeddings([query], resample=True)[0].tolist()
+        return self.audio_model.get_audio_embeddings([query], resample=True)[0].tolist()
+
+
+def normalize_query(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def embed_text_query(text: str) -> tuple[float]:
+    """Embed a (normalized) text query, memoized across calls in the process.
+
+    embed_text_query.cache_info() reports hits and misses.
+    """
+    return tuple(MODELS.get('text').get_text_embeddings([text])[0].tolist())
+
+
+# Memoized vectors belong to the model that computed them
+MODELS.listeners.append(embed_text_query.cache_clear)
+
+
+def embed_with_cache(cache: EmbeddingCache, items: list[str], key, embed) -> list[list[float]]:
+    """Embed only the items the cache has not seen; cache=None disables it."""
+    if cache is None:
+        return embed(items)
+
+    keys = [key(item) for item in items]
+    res = cache.get_many(keys)
+    missing = [i for i, vector in enumerate(res) if vector is None]
+    if missing:
+        embeddings = embed([items[i] for i in missing])
+        cache.put_many([keys[i] for i in missing], embeddings)
+        for i, embedding in zip(missing, embeddings):
+            res[i] = embedding
+    return res
+
+
+def embed_in_batches(embed, items: list, batch_size: int) -> list[list[float]]:
+    """Run embed over items in mini-batches and concatenate the rows."""
+    res = []
+    for start in range(0, len(items), batch_size):
+        res.extend(embed(items[start:start + batch_size]).tolist())
+    return res
 
 
 def normalize_embedding(embedding):
@@ -0,0 +1,193 @@
+"""Decode audio once into a memory-mapped PCM store for repeated embedding.
+
+Example:
+    python backend/feature_store.py backend/audio/jamendo --workers 8
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import threading
+import argparse
+import json
+import os
+
+from audio_stream import load_track
+
+
+FEATURE_DIR = 'backend/pcm_store'
+# CLAP resamples every input to 44.1 kHz
+SAMPLE_RATE = 44100
+
+
+def track_id(path: str) -> str:
+    """Tracks are keyed by file stem, the MTG-Jamendo track id."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class FeatureStore():
+    """Resampled mono 16-bit PCM of every track, keyed by track id.
+
+    samples.pcm holds all tracks back to back and index.json maps each id
+    to its [offset, length] in samples. Tracks are appended and never
+    rewritten; reads are slices of one memory map, so nothing is decoded
+    or copied until a clip is cut from them.
+
+    put_many appends one line per track to index.log rather than rewriting
+    index.json, and write_index folds the log into index.json once a
+    preprocess run is done.
+    """
+
+    def __init__(self, path: str = FEATURE_DIR, sample_rate: int = SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.tracks = None
+        self.samples = None
+
+    def open(self):
+        if self.tracks is not None:
+            return
+
+        index_path = os.path.join(self.path, 'index.json')
+        self.tracks = {}
+        if os.path.isfile(index_path):
+            with open(index_path) as fp:
+                index = json.load(fp)
+            if index['sample_rate'] != self.sample_rate:
+                raise ValueError(
+                    f"{self.path} holds {index['sample_rate']} Hz audio, not {self.sample_rate} Hz")
+            self.tracks = index['tracks']
+
+        log_path = os.path.join(self.path, 'index.log')
+        if os.path.isfile(log_path):
+            with open(log_path) as fp:
+                for line in fp:
+                    if not line.strip():
+                        continue
+                    try:
+                        id, offset, length = json.loads(line)
+                    except ValueError:
+                        # Torn by a crash mid-append; the track is decoded again
+                        continue
+                    self.tracks[id] = [offset, length]
+        # Mapped on the first read, so appends do not remap
+        self.samples = None
+
+    def map_samples(self):
+        samples_path = os.path.join(self.path, 'samples.pcm')
+        # np.memmap refuses empty files
+        if os.path.isfile(samples_path) and os.path.getsize(samples_path):
+            self.samples = np.memmap(samples_path, dtype=np.int16, mode='r')
+        else:
+            self.samples = np.zeros(0, dtype=np.int16)
+
+    def __contains__(self, id: str) -> bool:
+        with self.lock:
+            self.open()
+            return id in self.tracks
+
+    def __len__(self) -> int:
+        with self.lock:
+            self.open()
+            return len(self.tracks)
+
+    def get(self, id: str) -> np.ndarray:
+        """The track's int16 samples as a read-only view, or None."""
+        with self.lock:
+            self.open()
+            if id not in self.tracks:
+                return None
+            if self.samples is None:
+                self.map_samples()
+            offset, length = self.tracks[id]
+            return self.samples[offset:offset + length]
+
+    def put_many(self, ids: list[str], tracks: list[np.ndarray]):
+        """Append float tracks in [-1, 1] as 16-bit PCM."""
+        with self.lock:
+            self.open()
+            os.makedirs(self.path, exist_ok=True)
+            if not os.path.isfile(os.path.join(self.path, 'index.json')):
+                # Records the sample rate the log's tracks are stored at
+                self.write_index()
+
+            added = {}
+            with open(os.path.join(self.path, 'samples.pcm'), 'ab') as fp:
+                offset = fp.tell() // 2
+                for id, samples in zip(ids, tracks):
+                    pcm = (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+                    fp.write(pcm.tobytes())
+                    added[id] = [offset, len(pcm)]
+                    offset += len(pcm)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            # Samples are on disk before the index points at them. Records
+            # start with a newline, so one torn by a crash never runs into
+            # the next
+            with open(os.path.join(self.path, 'index.log'), 'a') as fp:
+                fp.write(''.join('\n' + json.dumps([id, *track]) for id, track in added.items()))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.tracks.update(added)
+            self.samples = None
+
+    def write_index(self):
+        """Rewrite index.json with every track and empty the log; call with the lock held."""
+        index_path = os.path.join(self.path, 'index.json')
+        with open(index_path + '.tmp', 'w') as fp:
+            json.dump({'sample_rate': self.sample_rate,
+                      'tracks': self.tracks}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(index_path + '.tmp', index_path)
+        # Replaying a log the new index already holds is harmless
+        open(os.path.join(self.path, 'index.log'), 'w').close()
+
+    def preprocess(self, files: list[str], workers: int = 1, chunk_size: int = 16) -> int:
+        """Decode and store every file not already stored; returns tracks added."""
+        todo = [file for file in files if track_id(file) not in self]
+        print(f'{len(files) - len(todo)} stored, decoding {len(todo)} files.')
+
+        added = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = [todo[start:start + chunk_size]
+                      for start in range(0, len(todo), chunk_size)]
+            for chunk, tracks in zip(chunks, executor.map(
+                    decode_chunk, chunks, [self.sample_rate] * len(chunks))):
+                decoded = [(track_id(file), samples)
+                           for file, samples in zip(chunk, tracks) if samples is not None]
+                self.put_many([id for id, _ in decoded],
+                              [samples for _, samples in decoded])
+                added += len(decoded)
+
+        if added:
+            with self.lock:
+                self.write_index()
+        return added
+
+
+def decode_chunk(files: list[str], sample_rate: int) -> list:
+    tracks = []
+    for file in files:
+        try:
+            tracks.append(load_track(file, sample_rate))
+        except Exception as e:
+            print(f'Failed to decode {file}: {e}')
+            tracks.append(None)
+    return tracks
+
+
+if __name__ == '__main__':
+    from bulk_index import find_audio
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+',
+                        help='audio files or directories')
+    parser.add_argument('--store', default=FEATURE_DIR)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=16)
+    args = parser.parse_args()
+
+    store = FeatureStore(args.store)
+    added = store.preprocess(find_audio(args.paths), args.workers, args.chunk_size)
+    print(f'Added {added} tracks; {len(store)} in {args.store}.')
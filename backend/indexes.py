@@ -0,0 +1,151 @@
+import faiss
+import numpy as np
+import math
+import time
+
+
+DEFAULT_SPEC = 'flat'
+PQ_M = 64
+HNSW_M = 32
+
+
+def factory_string(spec: str, n: int) -> str:
+    """Expand a short index spec into a faiss.index_factory string.
+
+    Accepts 'flat', 'ivf', 'ivfpq' and 'hnsw' (the IVF list count is sized
+    from the number of vectors n, and never exceeds it), or any raw factory
+    string such as 'IVF1024,PQ32'. 'ivfpq' skips polysemous training, which
+    took minutes on a few thousand vectors and is never used for search.
+    """
+    name = spec.lower()
+    nlist = max(1, min(int(4 * math.sqrt(n)), n))
+    if name == 'flat':
+        return 'Flat'
+    if name == 'ivf':
+        return f'IVF{nlist},Flat'
+    if name == 'ivfpq':
+        return f'IVF{nlist},PQ{PQ_M}np'
+    if name == 'hnsw':
+        return f'HNSW{HNSW_M}'
+    return spec
+
+
+def build_index(spec: str, vectors: np.ndarray) -> faiss.Index:
+    """Create an inner-product index for spec, train it and add vectors.
+
+    Too few vectors to train on (fewer than 256 for PQ, or none at all)
+    gives a flat index instead.
+    """
+    index = faiss.index_factory(vectors.shape[1], factory_string(
+        spec, len(vectors)), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        try:
+            index.train(vectors)
+        except RuntimeError:
+            print(f'Cannot train {spec} on {len(vectors)} vectors; using a flat index.')
+            index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    enable_reconstruct(index)
+    return index
+
+
+def needs_training(spec: str, d: int) -> bool:
+    return not faiss.index_factory(d, factory_string(spec, 1), faiss.METRIC_INNER_PRODUCT).is_trained
+
+
+def enable_reconstruct(index: faiss.Index):
+    """IVF indexes need a direct map before vectors can be reconstructed."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.no():
+        ivf.make_direct_map()
+
+
+def get_vectors(index: faiss.Index) -> np.ndarray:
+    """Reconstruct every stored vector (lossy for PQ indexes)."""
+    enable_reconstruct(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def search_params(index: faiss.Index, selector: faiss.IDSelector = None,
+                  nprobe: int = None, ef_search: int = None) -> faiss.SearchParameters:
+    """Search parameters matching the index type, or None if all defaults."""
+    if faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF()
+        if nprobe is not None:
+            params.nprobe = nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW()
+        if ef_search is not None:
+            params.efSearch = ef_search
+    elif selector is None:
+        return None
+    else:
+        params = faiss.SearchParameters()
+
+    if selector is not None:
+        params.sel = selector
+    return params
+
+
+def time_search(index: faiss.Index, queries: np.ndarray, k: int, params=None) -> tuple[np.ndarray, float]:
+    """Search queries one at a time, returning ids and mean latency in ms."""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    start = time.perf_counter()
+    for i, query in enumerate(queries):
+        _, ids[i] = index.search(query[None, :], k, params=params)
+    return ids, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall_report(vectors: np.ndarray, specs: list[str], k: int = 10, n_queries: int = 100,
+                  nprobes: list[int] = (1, 8, 32), ef_searches: list[int] = (16, 64, 256),
+                  seed: int = 0) -> list[dict]:
+    """Compare recall@k and query latency of each spec against exact search.
+
+    Queries are stored vectors sampled at random, so every one has an
+    exact match in the store.
+    """
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), min(
+        n_queries, len(vectors)), replace=False)]
+
+    exact = build_index('flat', vectors)
+    truth, flat_ms = time_search(exact, queries, k)
+    rows = [{'spec': 'flat', 'param': None, 'recall': 1.0, 'latency_ms': flat_ms}]
+
+    for spec in specs:
+        index = build_index(spec, vectors)
+        if faiss.try_extract_index_ivf(index) is not None:
+            settings = [('nprobe', p, search_params(index, nprobe=p))
+                        for p in nprobes]
+        elif isinstance(index, faiss.IndexHNSW):
+            settings = [('efSearch', e, search_params(index, ef_search=e))
+                        for e in ef_searches]
+        else:
+            settings = [(None, None, None)]
+
+        for name, value, params in settings:
+            found, ms = time_search(index, queries, k, params)
+            hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+            rows.append({'spec': factory_string(spec, len(vectors)),
+                         'param': f'{name}={value}' if name else None,
+                         'recall': hits / truth.size,
+                         'latency_ms': ms})
+    return rows
+
+
+def print_report(rows: list[dict]):
+    print(f"{'index':<24}{'param':<16}{'recall':>8}{'ms/query':>10}")
+    for row in rows:
+        print(
+            f"{row['spec']:<24}{row['param'] or '':<16}{row['recall']:>8.3f}{row['latency_ms']:>10.3f}")
+
+
+if __name__ == '__main__':
+    # Recall-vs-latency report for a saved store, e.g.
+    # python backend/indexes.py full_jamendo ivf ivfpq hnsw
+    import sys
+    from database import Database
+
+    name = sys.argv[1] if len(sys.argv) > 1 else 'first_100'
+    specs = sys.argv[2:] or ['ivf', 'ivfpq', 'hnsw']
+    Database(name).recall_report(specs)
@@ -0,0 +1,193 @@
+from database import Database
+from songs import Song
+
+import threading
+import traceback
+import queue
+import time
+import os
+
+
+# Marks the end of the stream on a queue
+STOP = object()
+
+
+class StageStats():
+    """Item count and busy time of one pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.busy = 0.0
+
+    def record(self, count: int, seconds: float):
+        with self.lock:
+            self.count += count
+            self.busy += seconds
+
+    def rate(self) -> float:
+        return self.count / self.busy if self.busy > 0 else 0.0
+
+    def latency(self) -> float:
+        """Mean seconds spent per item."""
+        return self.busy / self.count if self.count else 0.0
+
+
+class IngestPipeline():
+    """Producer/consumer ingestion into a Database.
+
+    Producers call submit() with downloaded songs; it blocks while
+    max_pending songs are waiting, which throttles the downloaders. One
+    embedding worker drains the queue in batches of up to batch_size (or
+    whatever arrived within flush_interval seconds) and hands them to a
+    single writer thread, the only one that takes Database.lock.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 16, flush_interval: float = 2.0,
+                 max_pending: int = 64, delete_files: bool = False):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.delete_files = delete_files
+
+        self.songs = queue.Queue(maxsize=max_pending)
+        self.batches = queue.Queue(maxsize=2)
+        self.stats = {name: StageStats(name)
+                      for name in ('download', 'embed', 'write')}
+        self.started = time.perf_counter()
+
+        self.embedder = threading.Thread(target=self.embed_loop, daemon=True)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.embedder.start()
+        self.writer.start()
+
+    def submit(self, song: Song, download_seconds: float = 0.0):
+        """Queue a downloaded song, blocking while the pipeline is full."""
+        self.stats['download'].record(1, download_seconds)
+        self.songs.put(song)
+
+    def drain(self):
+        """Block until every submitted song has been written."""
+        self.songs.join()
+        self.batches.join()
+
+    def close(self):
+        self.songs.put(STOP)
+        self.embedder.join()
+        self.writer.join()
+        self.report()
+
+    def next_batch(self) -> tuple[list[Song], bool]:
+        """Collect up to batch_size songs, waiting at most flush_interval after the first."""
+        song = self.songs.get()
+        if song is STOP:
+            return [], True
+
+        batch = [song]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                song = self.songs.get(
+                    timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if song is STOP:
+                return batch, True
+            batch.append(song)
+        return batch, False
+
+    def embed_loop(self):
+        done = False
+        while not done:
+            batch, done = self.next_batch()
+            if batch:
+                start = time.perf_counter()
+                try:
+                    songs, embeddings = self.embed(batch)
+                    self.stats['embed'].record(
+                        len(songs), time.perf_counter() - start)
+                    if songs:
+                        self.batches.put((songs, embeddings))
+                    # Every song was embedded or failed on its own
+                    self.remove_files(batch)
+                except Exception as e:
+                    print(f'Failed to embed batch of {len(batch)}: {e}')
+                    traceback.print_exc()
+                finally:
+                    for _ in batch:
+                        self.songs.task_done()
+            if done:
+                self.songs.task_done()
+        self.batches.put(STOP)
+
+    def embed(self, batch: list[Song]) -> tuple[list[Song], tuple[list, list]]:
+        """The songs that embedded and their embeddings (see Database.embed_songs).
+
+        If the batch fails, it is retried one song at a time so a single
+        bad download only loses itself.
+        """
+        try:
+            return batch, self.db.embed_songs(batch)
+        except Exception as e:
+            print(f'Failed to embed batch of {len(batch)}, retrying one by one: {e}')
+
+        songs, audio_embeddings, text_embeddings = [], [], []
+        for song in batch:
+            try:
+                (audio_embedding,), text_embedding = self.db.embed_songs([song])
+            except Exception as e:
+                print(f'Failed to embed {song.path}: {e}')
+                continue
+            songs.append(song)
+            audio_embeddings.append(audio_embedding)
+            text_embeddings.extend(text_embedding)
+        return songs, (audio_embeddings, text_embeddings)
+
+    def write_loop(self):
+        while True:
+            item = self.batches.get()
+            if item is STOP:
+                self.batches.task_done()
+                return
+
+            batch, (audio_embeddings, text_embeddings) = item
+            start = time.perf_counter()
+            try:
+                self.db.add_songs(batch, audio_embeddings, text_embeddings)
+                self.stats['write'].record(
+                    len(batch), time.perf_counter() - start)
+            except Exception as e:
+                print(f'Failed to write batch of {len(batch)}: {e}')
+                traceback.print_exc()
+            finally:
+                self.batches.task_done()
+
+    def remove_files(self, batch: list[Song]):
+        if not self.delete_files:
+            return
+        for song in batch:
+            if os.path.exists(song.path):
+                os.remove(song.path)
+
+    def report(self) -> dict:
+        """Print and return songs/sec per stage and end to end.
+
+        Embedding and writing are single threads, rated by their busy time.
+        Downloads overlap, so summing their times gives latency rather than
+        throughput: they are rated per wall-clock second, with the mean
+        download time reported beside it.
+        """
+        elapsed = time.perf_counter() - self.started
+        report = {name: {'songs': stats.count, 'songs_per_sec': stats.rate()}
+                  for name, stats in self.stats.items()}
+        download = self.stats['download']
+        report['download'] = {'songs': download.count, 'songs_per_sec': download.count / elapsed,
+                              'seconds_per_song': download.latency()}
+        report['total'] = {'songs': self.stats['write'].count,
+                           'songs_per_sec': self.stats['write'].count / elapsed}
+        for name, row in report.items():
+            latency = f"{row['seconds_per_song']:>8.2f} s/song" if 'seconds_per_song' in row else ''
+            print(
+                f"{name:<10}{row['songs']:>8} songs{row['songs_per_sec']:>10.2f} songs/sec{latency}")
+        return report
@@ -0,0 +1,145 @@
+import numpy as np
+
+from songs import MetaSet
+from tags import TAGS, TAG_FIELDS
+
+
+# Top-level filter keys the index evaluates; '$and', '$or' and '$not'
+# combine nested filters.
+FILTER_FIELDS = ('doc_type', 'duration') + TAG_FIELDS
+OPERATORS = ('$and', '$or', '$not')
+
+
+def mask_words(mask: int, words: int) -> list[int]:
+    """Split a tag bitmask into uint64 words, lowest bits first."""
+    return [(mask >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(words)]
+
+
+def as_meta_set(value) -> MetaSet:
+    if isinstance(value, MetaSet):
+        return value
+    if isinstance(value, str):
+        return MetaSet({value})
+    return MetaSet(set(value))
+
+
+class MetadataIndex():
+    """Columnar filter engine over one store's rows.
+
+    Each tag field is an (n, words) uint64 array of TAGS bitmasks and
+    durations a float32 array, so a filter is evaluated for the whole
+    catalog with a handful of NumPy operations. Filter semantics:
+
+        {'genre': MetaSet({'rock', 'pop'})}   any overlap (also a str or set)
+        {'duration': (60, 300)}               inclusive range, None for open
+        {'doc_type': 'audio'}                 equality (or a tuple of types)
+        {'$or': [f1, f2]}, {'$and': [...]}, {'$not': f}
+
+    Separate keys of one dict are ANDed, as before.
+    """
+
+    def __init__(self, doc_type: str = None):
+        self.doc_type = doc_type
+        self.words = 1
+        self.tag_masks = {field: np.zeros((0, 1), dtype=np.uint64)
+                          for field in TAG_FIELDS}
+        self.duration = np.zeros(0, dtype=np.float32)
+        self.pending = []
+
+    @classmethod
+    def from_csr(cls, doc_type: str, duration: np.ndarray, tags: dict) -> 'MetadataIndex':
+        """Build from columns: tags maps field -> (offsets, tag_ids, vocab)."""
+        index = cls(doc_type)
+        index.duration = np.asarray(duration, dtype=np.float32)
+        n = len(index.duration)
+        # Register every stored tag before sizing the words
+        tag_bits = {field: np.array([TAGS.bit(tag) for tag in vocab], dtype=np.int64)
+                    for field, (_, _, vocab) in tags.items()}
+        index.words = max(1, (len(TAGS) + 63) // 64)
+        for field, (offsets, tag_ids, _) in tags.items():
+            bits = tag_bits[field][np.asarray(tag_ids)]
+            rows = np.repeat(np.arange(n), np.diff(offsets))
+            masks = np.zeros((n, index.words), dtype=np.uint64)
+            np.bitwise_or.at(masks, (rows, bits // 64),
+                             np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+            index.tag_masks[field] = masks
+        return index
+
+    @property
+    def size(self) -> int:
+        return len(self.duration) + len(self.pending)
+
+    def add(self, i: int, metadata: dict):
+        self.pending.append(metadata)
+
+    def add_many(self, start: int, metadatas: list[dict]):
+        for offset, metadata in enumerate(metadatas):
+            self.add(start + offset, metadata)
+
+    def flush(self):
+        """Append pending rows to the column arrays."""
+        words = max(1, (len(TAGS) + 63) // 64)
+        if words > self.words:
+            for field, masks in self.tag_masks.items():
+                self.tag_masks[field] = np.pad(
+                    masks, ((0, 0), (0, words - self.words)))
+            self.words = words
+        if not self.pending:
+            return
+
+        for field in TAG_FIELDS:
+            new = np.array([mask_words(metadata[field].mask if field in metadata else 0, words)
+                            for metadata in self.pending], dtype=np.uint64)
+            self.tag_masks[field] = np.concatenate(
+                [self.tag_masks[field], new])
+        self.duration = np.concatenate([self.duration, np.array(
+            [metadata.get('duration', 0.0) for metadata in self.pending], dtype=np.float32)])
+        self.pending = []
+
+    def supports(self, filter: dict) -> bool:
+        for field, value in filter.items():
+            if field in ('$and', '$or'):
+                if not all(self.supports(f) for f in value):
+                    return False
+            elif field == '$not':
+                if not self.supports(value):
+                    return False
+            elif field not in FILTER_FIELDS:
+                return False
+        return True
+
+    def evaluate(self, filter: dict) -> np.ndarray:
+        """Boolean mask over every row for a filter of indexed fields."""
+        self.flush()
+        mask = np.ones(self.size, dtype=bool)
+        for field, value in filter.items():
+            if field == '$and':
+                for f in value:
+                    mask &= self.evaluate(f)
+            elif field == '$or':
+                any_mask = np.zeros(self.size, dtype=bool)
+                for f in value:
+                    any_mask |= self.evaluate(f)
+                mask &= any_mask
+            elif field == '$not':
+                mask &= ~self.evaluate(value)
+            elif field == 'doc_type':
+                types = (value,) if isinstance(value, str) else tuple(value)
+                mask &= self.doc_type in types
+            elif field == 'duration':
+                low, high = value
+                if low is not None:
+                    mask &= self.duration >= low
+                if high is not None:
+                    mask &= self.duration <= high
+            elif field in TAG_FIELDS:
+                query = np.array(mask_words(
+                    as_meta_set(value).mask, self.words), dtype=np.uint64)
+                mask &= (self.tag_masks[field] & query).any(axis=1)
+            else:
+                raise ValueError(f"Cannot filter on {field}")
+        return mask
+
+    def resolve(self, filter: dict) -> np.ndarray:
+        """Return the sorted row ids matching the filter."""
+        return np.flatnonzero(self.evaluate(filter)).astype(np.int64)
@@ -0,0 +1,238 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import json
+import time
+import os
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, float('inf'))
+PREFIX = 'vibesync'
+DEFAULT_PORT = 9108
+
+
+class NullTimer():
+    """What timer() and trace() return while metrics are off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Histogram():
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+
+class Timer():
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Trace():
+    """Collects the timers observed on this thread while it is open."""
+
+    def __init__(self, metrics: 'Metrics', name: str, fields: dict):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+        self.spans = []
+
+    def __enter__(self):
+        self.parent = getattr(self.metrics.local, 'trace', None)
+        self.metrics.local.trace = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        self.metrics.local.trace = self.parent
+        self.metrics.observe(self.name, seconds)
+        self.metrics.write_trace({'name': self.name, 'time': time.time(),
+                                  'ms': seconds * 1000, **self.fields,
+                                  'error': repr(exc) if exc else None,
+                                  'spans': self.spans})
+        return False
+
+
+class Metrics():
+    """Opt-in timers, counters and per-request traces.
+
+    Off by default: timer() and trace() then return a shared no-op context
+    and count() returns at once, so instrumented code pays one attribute
+    check. enable() turns recording on and can serve the metrics over
+    HTTP (/metrics in Prometheus text format, /metrics.json as JSON) and
+    append one JSON line per trace to a log file.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.histograms = {}
+        self.counters = {}
+        self.trace_log = None
+        self.server = None
+
+    def enable(self, port: int = None, trace_log: str = None):
+        """Start recording; safe to call again (e.g. on every Streamlit rerun)."""
+        with self.lock:
+            self.enabled = True
+            if trace_log and self.trace_log is None:
+                self.trace_log = open(trace_log, 'a', buffering=1)
+            if port and self.server is None:
+                self.server = ThreadingHTTPServer(
+                    ('127.0.0.1', port), self.handler())
+                threading.Thread(target=self.server.serve_forever,
+                                 daemon=True).start()
+                print(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+
+    def enable_from_env(self):
+        """Enable if VIBESYNC_METRICS is set; VIBESYNC_METRICS_PORT and
+        VIBESYNC_TRACE_LOG pick the endpoint port and the trace file."""
+        if os.environ.get('VIBESYNC_METRICS'):
+            self.enable(int(os.environ.get('VIBESYNC_METRICS_PORT', DEFAULT_PORT)),
+                        os.environ.get('VIBESYNC_TRACE_LOG'))
+
+    def disable(self):
+        self.enabled = False
+
+    def timer(self, name: str):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def trace(self, name: str, **fields):
+        if not self.enabled:
+            return NULL_TIMER
+        return Trace(self, name, fields)
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace.spans.append({'name': name, 'ms': seconds * 1000})
+
+    def write_trace(self, record: dict):
+        if self.trace_log is not None:
+            line = json.dumps(record, default=str)
+            with self.lock:
+                self.trace_log.write(line + '\n')
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'timers': {name: {'count': h.count, 'sum_seconds': h.sum,
+                                      'mean_ms': h.sum / h.count * 1000 if h.count else 0.0}
+                               for name, h in self.histograms.items()},
+                    'counters': dict(self.counters)}
+
+    def prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f'{PREFIX}_{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum {histogram.sum}')
+                lines.append(f'{metric}_count {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+                lines.append(f'{PREFIX}_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(
+                        metrics.snapshot()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class TimedLock():
+    """Wraps a lock, recording how long each acquire waited as name."""
+
+    def __init__(self, lock, name: str, metrics: Metrics):
+        self.lock = lock
+        self.name = name
+        self.metrics = metrics
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if not self.metrics.enabled:
+            return self.lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.metrics.observe(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+METRICS = Metrics()
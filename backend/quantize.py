@@ -0,0 +1,131 @@
+import faiss
+import numpy as np
+import os
+
+from indexes import time_search
+
+
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+# numpy dtype of the codes kept in vectors.npy
+STORAGE_DTYPES = {'float32': np.float32,
+                  'float16': np.float16, 'int8': np.uint8}
+QTYPES = {'float16': faiss.ScalarQuantizer.QT_fp16,
+          'int8': faiss.ScalarQuantizer.QT_8bit}
+RANGESTATS = {'minmax': faiss.ScalarQuantizer.RS_minmax,
+              'meanstd': faiss.ScalarQuantizer.RS_meanstd,
+              'quantiles': faiss.ScalarQuantizer.RS_quantiles,
+              'optim': faiss.ScalarQuantizer.RS_optim}
+
+
+def train_quantizer(vectors: np.ndarray, rangestat: str = 'minmax') -> faiss.ScalarQuantizer:
+    """Per-dimension 8-bit quantizer with ranges fit to vectors.
+
+    rangestat picks how each dimension's range is chosen: 'minmax' covers
+    every value, while 'meanstd', 'quantiles' and 'optim' clip outliers
+    for finer steps over the bulk of the values.
+    """
+    quantizer = faiss.ScalarQuantizer(vectors.shape[1], QTYPES['int8'])
+    quantizer.rangestat = RANGESTATS[rangestat]
+    quantizer.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    return quantizer
+
+
+def load_quantizer(trained: np.ndarray) -> faiss.ScalarQuantizer:
+    """Rebuild a quantizer from its saved ranges (minimums then widths)."""
+    quantizer = faiss.ScalarQuantizer(len(trained) // 2, QTYPES['int8'])
+    faiss.copy_array_to_vector(
+        np.asarray(trained, dtype=np.float32), quantizer.trained)
+    return quantizer
+
+
+def encode(vectors: np.ndarray, vector_dtype: str,
+           quantizer: faiss.ScalarQuantizer = None) -> np.ndarray:
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vector_dtype == 'int8':
+        return quantizer.compute_codes(vectors)
+    return vectors.astype(STORAGE_DTYPES[vector_dtype])
+
+
+def decode(codes: np.ndarray, vector_dtype: str,
+           quantizer: faiss.ScalarQuantizer = None) -> np.ndarray:
+    if vector_dtype == 'int8' and len(codes):
+        return quantizer.decode(np.ascontiguousarray(codes))
+    return np.asarray(codes, dtype=np.float32)
+
+
+def flat_index(dim: int, vector_dtype: str, quantizer: faiss.ScalarQuantizer = None) -> faiss.Index:
+    """Empty exact inner-product index that scans codes at the stored precision."""
+    if vector_dtype == 'float32':
+        return faiss.IndexFlatIP(dim)
+
+    index = faiss.IndexScalarQuantizer(
+        dim, QTYPES[vector_dtype], faiss.METRIC_INNER_PRODUCT)
+    if quantizer is not None:
+        faiss.copy_array_to_vector(
+            faiss.vector_to_array(quantizer.trained), index.sq.trained)
+    index.is_trained = True
+    return index
+
+
+def overlap_report(vectors: np.ndarray, dtypes: list[str] = ('float16', 'int8'), k: int = 10,
+                   n_queries: int = 100, rangestat: str = 'minmax', seed: int = 0) -> list[dict]:
+    """Compare top-k overlap, memory and latency of each dtype with float32.
+
+    Queries are stored vectors sampled at random and the baseline is an
+    exact float32 scan, so overlap is the fraction of float32's top k a
+    reduced-precision scan still returns.
+    """
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), min(
+        n_queries, len(vectors)), replace=False)]
+
+    exact = flat_index(vectors.shape[1], 'float32')
+    exact.add(vectors)
+    truth, flat_ms = time_search(exact, queries, k)
+    rows = [{'dtype': 'float32', 'bytes_per_vector': vectors.shape[1] * 4,
+             'overlap': 1.0, 'latency_ms': flat_ms}]
+
+    for vector_dtype in dtypes:
+        quantizer = train_quantizer(
+            vectors, rangestat) if vector_dtype == 'int8' else None
+        index = flat_index(vectors.shape[1], vector_dtype, quantizer)
+        index.add(vectors)
+        found, ms = time_search(index, queries, k)
+        hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+        rows.append({'dtype': vector_dtype, 'bytes_per_vector': index.code_size,
+                     'overlap': hits / truth.size, 'latency_ms': ms})
+    return rows
+
+
+def print_report(rows: list[dict]):
+    print(f"{'dtype':<10}{'bytes/vec':>10}{'overlap':>9}{'ms/query':>10}")
+    for row in rows:
+        print(
+            f"{row['dtype']:<10}{row['bytes_per_vector']:>10}{row['overlap']:>9.3f}{row['latency_ms']:>10.3f}")
+
+
+if __name__ == '__main__':
+    # Convert saved stores to reduced precision and report top-k overlap
+    # with float32, e.g. python backend/quantize.py int8 full_jamendo
+    import argparse
+    from database import Database
+
+    parser = argparse.ArgumentParser(
+        description='Convert vector stores to float16 or int8 vectors.')
+    parser.add_argument('dtype', choices=VECTOR_DTYPES)
+    parser.add_argument('stores', nargs='*',
+                        help='names under backend/vector_stores (default all)')
+    parser.add_argument('--rangestat', choices=RANGESTATS, default='minmax')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+
+    for name in args.stores or sorted(os.listdir('backend/vector_stores')):
+        db = Database(name)
+        for doc_type, store in db.stores.items():
+            if store.ntotal:
+                print(f'{name}/{doc_type} (stored as {store.vector_dtype}):')
+                print_report(overlap_report(store.all_vectors(), [args.dtype], args.k,
+                                            args.queries, args.rangestat))
+        db.set_vector_dtype(args.dtype, args.rangestat)
+        db.save_db()
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import threading
+import time
+
+from songs import MetaSet
+
+
+class ResultCache():
+    """Small LRU cache whose entries expire ttl seconds after insertion."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+def filter_key(filter):
+    """Hashable form of a filter (MetaSets become sorted tag tuples)."""
+    if isinstance(filter, MetaSet):
+        return tuple(sorted(filter.items))
+    if isinstance(filter, dict):
+        return tuple(sorted((field, filter_key(value)) for field, value in filter.items()))
+    if isinstance(filter, (list, tuple)):
+        return tuple(filter_key(value) for value in filter)
+    if isinstance(filter, set):
+        return tuple(sorted(filter))
+    return filter
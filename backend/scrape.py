@@ -1,5 +1,7 @@
-from commons import read_file
+from track_table import load_tracks
 from database import Database
+from ingest import IngestPipeline
+from downloads import DownloadTracker
 from songs import Song
 import traceback
 import time
@@ -17,46 +19,16 @@ from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from numpy import random
 random.seed(42)
-TRACKS, TAGS, EXTRA = read_file('mtgdataset/data/autotagging.tsv')
-
-
-def download_and_post(download_dir, song_metadata,
-                      download_suffix=".crdownload", wait_time=10, start_buffer=0.5):
-    # wait for download
-    filename_prefix = song_metadata['title'].replace(" ", "_")
-    t = 0
-    time.sleep(start_buffer)
-
-    # Wait for the download to start
-    matching_files = None
-    while True:
-        files = os.listdir(download_dir)
-        matching_files = [
-            f for f in files if f.startswith(filename_prefix)]
-        if matching_files:
-            break
-        time.sleep(0.5)
-        t += 0.5
-        if t >= wait_time:
-            print("Failed to find file for download", filename_prefix)
-            return
+TRACKS = load_tracks('mtgdataset/data/autotagging.tsv')
 
-    # get most recent matching file
-    matching_files = [os.path.join(download_dir, f)
-                      for f in matching_files]
-    matching_files.sort(
-        key=lambda x: os.path.getmtime(x), reverse=True)
-    current_file = matching_files[0]
-    if current_file.endswith(download_suffix):
-        current_file = current_file[:-len(download_suffix)]
-
-    # Wait for the download to complete
-    while not os.path.exists(current_file):
-        time.sleep(0.5)
-        t += 0.5
-        if t >= wait_time:
-            print("Failed to download file", current_file)
-            return
+
+def post_download(song_metadata, future):
+    """Hand a finished download to the ingest pipeline."""
+    try:
+        current_file, download_seconds = future.result()
+    except TimeoutError as e:
+        print("Failed to download file", e)
+        return
 
     # post to DB
     id = song_metadata['id']
@@ -69,12 +41,23 @@ def download_and_post(download_dir, song_metadata,
                        instrument=track['instrument'],
                        moodtheme=track['mood/theme'],
                        description=song_metadata['description'])
-    DB.post_songs([song_object])
-    if os.path.exists(current_file):
-        os.remove(current_file)
+    # The pipeline embeds in batches and deletes the file afterwards
+    PIPELINE.submit(song_object, download_seconds)
+
+
+def post_finished(downloads, block=False):
+    """Post downloads whose futures have resolved, oldest first."""
+    while downloads and (block or downloads[0][1].done()):
+        post_download(*downloads.popleft())
+
 
+def download_song(track_id_list, download_wait_time=30, max_downloads=8, process=1):
+    """Download and post tracks through one logged-in browser.
 
-def download_song(track_id_list, download_wait_time=30, min_threads=1, max_threads=2, process=1):
+    The browser moves on as soon as a download is clicked; TRACKER resolves
+    each download when the file lands, and up to max_downloads may be in
+    flight at once.
+    """
     download_dir = os.path.abspath(f"backend/audio/{process}")
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
@@ -89,6 +72,7 @@ def download_song(track_id_list, download_wait_time=30, min_threads=1, max_threa
     }
     chrome_options.add_experimental_option("prefs", prefs)
     driver = webdriver.Chrome(options=chrome_options)
+    downloads = deque()
 
     try:
         idx = 0
@@ -137,73 +121,77 @@ def download_song(track_id_list, download_wait_time=30, min_threads=1, max_threa
         time.sleep(2)
         # print("Login completed!")
         # print("Logged in successfully!")
-        with ThreadPoolExecutor(max_workers=max_threads) as executor:
-            futures = deque()
-            for idx, id in enumerate(track_id_list):
-                # Define the url to the track_id
-                url = "https://www.jamendo.com/track/" + str(id)
-
-                driver.get(url)
-
-                # Wait for the Download button to load
-                # print("Waiting for the Download button")
-                download_button = None
-                try:
-                    download_button = WebDriverWait(driver, 1).until(
-                        EC.element_to_be_clickable(
-                            (By.CLASS_NAME, "js-abtesting-trigger-start"))
-                    )
-                except Exception as e:
-                    continue
-
-                # Click the Download button
-                # print("Clicking the download button")
-                download_button.click()
-                # print("Download button clicked")
-
-                song_title_element = driver.find_element(
-                    By.XPATH, "//h1[@class='primary']/span")
-                song_title = song_title_element.text
-
-                artist_name_element = driver.find_element(
-                    By.XPATH, "//a[@class='secondary']/span")
-                artist = artist_name_element.text
-
-                # Wait for the download button to load
-                try:
-                    download_button = WebDriverWait(driver, 0.2).until(
-                        EC.element_to_be_clickable(
-                            (By.CLASS_NAME, "js-overlay-download"))
-                    )
-                except Exception as e:
-                    continue
-
-                # Click the Free Download button
-                download_button.click()
-                time.sleep(0.2)
-
-                song_metadata = {
-                    "title": song_title,
-                    "artist": artist,
-                    "url": url,
-                    "id": id,
-                    "description": ""
-                }
-                # add download thread
-                futures.append(executor.submit(download_and_post, download_dir,
-                                               song_metadata, wait_time=download_wait_time))
-
-                if len(futures) >= max_threads:
-                    while len(futures) > min_threads:
-                        futures.popleft().result()
+        for idx, id in enumerate(track_id_list):
+            post_finished(downloads)
+            while len(downloads) >= max_downloads:
+                post_download(*downloads.popleft())
+
+            # Define the url to the track_id
+            url = "https://www.jamendo.com/track/" + str(id)
+
+            requested = time.time()
+            driver.get(url)
+
+            # Wait for the Download button to load
+            # print("Waiting for the Download button")
+            download_button = None
+            try:
+                download_button = WebDriverWait(driver, 1).until(
+                    EC.element_to_be_clickable(
+                        (By.CLASS_NAME, "js-abtesting-trigger-start"))
+                )
+            except Exception as e:
+                continue
+
+            # Click the Download button
+            # print("Clicking the download button")
+            download_button.click()
+            # print("Download button clicked")
+
+            song_title_element = driver.find_element(
+                By.XPATH, "//h1[@class='primary']/span")
+            song_title = song_title_element.text
+
+            artist_name_element = driver.find_element(
+                By.XPATH, "//a[@class='secondary']/span")
+            artist = artist_name_element.text
+
+            # Wait for the download button to load
+            try:
+                download_button = WebDriverWait(driver, 0.2).until(
+                    EC.element_to_be_clickable(
+                        (By.CLASS_NAME, "js-overlay-download"))
+                )
+            except Exception as e:
+                continue
+
+            # Click the Free Download button
+            download_button.click()
+            time.sleep(0.2)
+
+            song_metadata = {
+                "title": song_title,
+                "artist": artist,
+                "url": url,
+                "id": id,
+                "description": ""
+            }
+            # The tracker resolves the download when the file is finalized
+            downloads.append((song_metadata, TRACKER.expect(
+                download_dir, song_title.replace(" ", "_"),
+                timeout=download_wait_time, since=requested)))
     except Exception as e:
         print(f"An error occurred: {e}")
         traceback.print_exc()
+        post_finished(downloads, block=True)
 
         download_song(track_id_list[idx+1:], download_wait_time=download_wait_time,
-                      min_threads=min_threads, max_threads=max_threads, process=process)
+                      max_downloads=max_downloads, process=process)
     finally:
+        # Quitting the browser would cancel downloads still in flight
+        post_finished(downloads, block=True)
         driver.quit()
+        PIPELINE.drain()
         for file in os.listdir(download_dir):
             os.remove(os.path.join(download_dir, file))
         os.rmdir(download_dir)
@@ -224,10 +212,9 @@ def download_song_parallel(track_id_list, max_processes=10):
 
 def main(processes=2, batches=4, max_songs=100):
     if max_songs is not None:  # randomly select a subset of the tracks
-        track_id_list = random.choice(
-            list(TRACKS.keys()), max_songs, replace=False)
+        track_id_list = random.choice(TRACKS.ids, max_songs, replace=False)
     else:
-        track_id_list = list(TRACKS.keys())
+        track_id_list = TRACKS.ids.tolist()
 
     # Run the download_song feature using this function
     start_time = time.time()
@@ -239,8 +226,13 @@ def main(processes=2, batches=4, max_songs=100):
             track_id_list[start:end], max_processes=processes)
     elapsed_time = time.time() - start_time
     print(f"Elapsed_time: {elapsed_time/60:.2f} minutes")
+    PIPELINE.close()
+    TRACKER.close()
+    TRACKER.report()
 
 
 if __name__ == "__main__":
     DB = Database(f'scrape_test', True)
+    PIPELINE = IngestPipeline(DB, batch_size=16, delete_files=True)
+    TRACKER = DownloadTracker()
     main()
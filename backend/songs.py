@@ -1,7 +1,12 @@
 from typing import Set
 
+from tags import TAGS
+
 
 class Song():
+    __slots__ = ('title', 'path', 'artist', 'url', 'id', 'duration',
+                 'genre', 'instrument', 'moodtheme', 'description')
+
     def __init__(self, title: str, path: str, id: str, artist: str = "", url: str = "",
                  duration: float = 0.0, genre: Set[str] = set(),
                  instrument: Set[str] = set(), moodtheme: Set[str] = set(), description: str = "",):
@@ -17,23 +22,44 @@ class Song():
         self.description = description
 
     def get_metadata(self) -> dict:
-        return vars(self)
+        return {field: getattr(self, field) for field in self.__slots__}
 
 # Set class for comparing sets of metadata where equality is
+# any overlap. Tags are held as a bitmask over the shared TAGS vocabulary.
 
 
 class MetaSet():
+    __slots__ = ('mask',)
+
     def __init__(self, items: set = set()):
-        self.items = items
+        self.mask = TAGS.mask(items)
+
+    @classmethod
+    def from_mask(cls, mask: int) -> 'MetaSet':
+        meta_set = cls()
+        meta_set.mask = mask
+        return meta_set
+
+    @property
+    def items(self) -> set:
+        return TAGS.items(self.mask)
+
+    # Pickled as the tags, as before the bitmask: bits are only meaningful
+    # to the TAGS vocabulary of the process that assigned them
+    def __getstate__(self) -> dict:
+        return {'items': self.items}
+
+    def __setstate__(self, state: dict):
+        self.mask = TAGS.mask(state['items'])
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return len(self.items.intersection(other.items)) > 0
+            return self.mask & other.mask != 0
         else:
             return False
 
     def __len__(self):
-        return len(self.items)
+        return self.mask.bit_count()
 
     def __str__(self):
         return "M"+str(self.items)
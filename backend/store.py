@@ -0,0 +1,394 @@
+import faiss
+from langchain_core.documents import Document
+import numpy as np
+import shutil
+import json
+import os
+
+from songs import MetaSet
+from tags import TAGS, TAG_FIELDS
+from metadata_index import MetadataIndex
+from columns import write_strings, open_bytes, append_npy
+import quantize
+
+
+# Columns of Song.get_metadata(); anything else is not persisted
+STRING_FIELDS = ('title', 'path', 'artist', 'url', 'id', 'description')
+FLOAT_FIELDS = ('duration',)
+
+
+def tag_lists(metadatas: list[dict], field: str, vocab: list[str]) -> tuple[list[int], list[int]]:
+    """Per-row tag counts and the tag ids of field, growing vocab with new tags."""
+    tag_ids = {tag: t for t, tag in enumerate(vocab)}
+    counts, ids = [], []
+    for metadata in metadatas:
+        tags = sorted(metadata[field].items if field in metadata else ())
+        for tag in tags:
+            if tag not in tag_ids:
+                tag_ids[tag] = len(vocab)
+                vocab.append(tag)
+            ids.append(tag_ids[tag])
+        counts.append(len(tags))
+    return counts, ids
+
+
+class ColumnStore():
+    """Vectors and song metadata for one modality, without pickle.
+
+    On disk, vectors.npy holds the L2-normalized vectors as float32,
+    float16 or int8 scalar-quantized codes (with the quantizer's ranges in
+    quantizer.npy), and every metadata field is a column: strings as a UTF-8 blob
+    plus offsets, durations as float32 and tags as CSR lists of ids into a
+    per-field vocabulary kept in meta.json. Everything is memory-mapped on
+    open, so opening costs the same at any size and rows are decoded only
+    when a document is read. Rows added since the last save are held in
+    memory until the next save.
+
+    Deleted rows are tombstoned: their row numbers are kept in dead (and
+    deleted.npy) and dropped from rows, and search skips them until a
+    save with an explicit row list compacts them away.
+    """
+
+    def __init__(self, doc_type: str, dim: int, vector_dtype: str = 'float32'):
+        self.doc_type = doc_type
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.path = None
+        self.size = 0
+        self.vectors = np.zeros(
+            (0, dim), dtype=quantize.STORAGE_DTYPES[vector_dtype])
+        # Trained on the first save of an int8 store
+        self.quantizer = None
+        self.columns = {}
+        self.vocab = {field: [] for field in TAG_FIELDS}
+
+        self.new_vectors = []
+        self.new_metadatas = []
+
+        self._index = None
+        self._default_index = False
+        self._metadata_index = None
+        self._rows = None
+        self.dead = set()
+        self._dead_rows = None
+
+    @classmethod
+    def open(cls, path: str) -> 'ColumnStore':
+        with open(os.path.join(path, 'meta.json')) as fp:
+            meta = json.load(fp)
+        store = cls(meta['doc_type'], meta['dim'], meta['vector_dtype'])
+        store.map_columns(path, meta)
+        return store
+
+    def map_columns(self, path: str, meta: dict):
+        self.path = path
+        self.size = meta['size']
+        self.vocab = meta['vocab']
+        # Stored tag id -> bit in this process's TAGS vocabulary
+        self.tag_bits = {field: [1 << TAGS.bit(tag) for tag in self.vocab[field]]
+                         for field in TAG_FIELDS}
+        self.vectors = np.load(os.path.join(
+            path, 'vectors.npy'), mmap_mode='r')
+        quantizer_path = os.path.join(path, 'quantizer.npy')
+        if os.path.isfile(quantizer_path):
+            self.quantizer = quantize.load_quantizer(np.load(quantizer_path))
+        self.columns = {}
+        for field in STRING_FIELDS + TAG_FIELDS:
+            self.columns[field] = (np.load(os.path.join(path, f'{field}.offsets.npy'), mmap_mode='r'),
+                                   open_bytes(os.path.join(path, f'{field}.bytes')) if field in STRING_FIELDS
+                                   else np.load(os.path.join(path, f'{field}.ids.npy'), mmap_mode='r'))
+        for field in FLOAT_FIELDS:
+            self.columns[field] = np.load(os.path.join(
+                path, f'{field}.npy'), mmap_mode='r')
+        deleted_path = os.path.join(path, 'deleted.npy')
+        self.dead = set(np.load(deleted_path).tolist()) if os.path.isfile(deleted_path) else set()
+        self._dead_rows = None
+
+    @property
+    def ntotal(self) -> int:
+        return self.size + len(self.new_metadatas)
+
+    @property
+    def index(self) -> faiss.Index:
+        """FAISS index over every row; a saved flat index is rebuilt from vectors.
+
+        The rebuilt index scans the vectors at the stored precision, copying
+        the stored codes rather than re-encoding them. Setting None switches
+        back to it.
+        """
+        if self._index is None:
+            index_path = os.path.join(self.path or '', 'index.faiss')
+            if os.path.isfile(index_path):
+                self._index = faiss.read_index(index_path)
+            else:
+                self._index = self.flat_index()
+                self._default_index = True
+        return self._index
+
+    @property
+    def flat(self) -> bool:
+        """Whether searches scan the stored vectors rather than a built index."""
+        return self.index is not None and self._default_index
+
+    @index.setter
+    def index(self, index: faiss.Index):
+        self._default_index = index is None
+        self._index = self.flat_index() if index is None else index
+
+    def flat_index(self) -> faiss.Index:
+        if self.vector_dtype == 'int8' and self.quantizer is None:
+            # Nothing to quantize with until the first save
+            index = quantize.flat_index(self.dim, 'float32')
+            if self.ntotal:
+                index.add(self.all_vectors())
+            return index
+
+        index = quantize.flat_index(self.dim, self.vector_dtype, self.quantizer)
+        if self.size:
+            index.add_sa_codes(np.ascontiguousarray(
+                self.vectors).view(np.uint8))
+        if self.new_vectors:
+            index.add(np.array(self.new_vectors))
+        return index
+
+    def set_vector_dtype(self, vector_dtype: str, rangestat: str = 'minmax'):
+        """Re-encode the stored vectors; int8 trains a quantizer on them."""
+        vectors = self.all_vectors()
+        self.vector_dtype = vector_dtype
+        self.quantizer = None
+        if vector_dtype == 'int8' and len(vectors):
+            self.quantizer = quantize.train_quantizer(vectors, rangestat)
+        self.vectors = self.encode(vectors[:self.size])
+        if self._default_index:
+            self._index = None
+
+    @property
+    def metadata_index(self) -> MetadataIndex:
+        """Filter columns, built from the tag and duration columns on first use."""
+        if self._metadata_index is None:
+            if self.size:
+                self._metadata_index = MetadataIndex.from_csr(
+                    self.doc_type, self.columns['duration'],
+                    {field: (*self.columns[field], self.vocab[field]) for field in TAG_FIELDS})
+            else:
+                self._metadata_index = MetadataIndex(self.doc_type)
+            self._metadata_index.add_many(self.size, self.new_metadatas)
+        return self._metadata_index
+
+    @property
+    def rows(self) -> dict:
+        """Song id -> live row."""
+        if self._rows is None:
+            offsets, blob = self.columns['id'] if self.size else (None, None)
+            self._rows = {bytes(blob[offsets[i]:offsets[i + 1]]).decode(): i
+                          for i in range(self.size) if i not in self.dead}
+            for i, metadata in enumerate(self.new_metadatas):
+                if self.size + i not in self.dead:
+                    self._rows[metadata['id']] = self.size + i
+        return self._rows
+
+    @property
+    def dead_rows(self) -> np.ndarray:
+        """Sorted tombstoned rows, for the search selector."""
+        if self._dead_rows is None:
+            self._dead_rows = np.array(sorted(self.dead), dtype=np.int64)
+        return self._dead_rows
+
+    def live_rows(self) -> np.ndarray:
+        return np.setdiff1d(np.arange(self.ntotal, dtype=np.int64), self.dead_rows)
+
+    def delete(self, ids: list[str]) -> int:
+        """Tombstone the live rows of song ids; returns how many there were."""
+        rows = self.rows
+        dead = [rows.pop(id) for id in ids if id in rows]
+        if dead:
+            self.dead.update(dead)
+            self._dead_rows = None
+        return len(dead)
+
+    def upsert(self, titles: list[str], embeddings: list[list[float]],
+               metadatas: list[dict], ids: list[str]) -> list[str]:
+        """Add rows, first tombstoning any stored under the same song ids."""
+        self.delete([metadata['id'] for metadata in metadatas])
+        return self.add(titles, embeddings, metadatas, ids)
+
+    def add(self, titles: list[str], embeddings: list[list[float]],
+            metadatas: list[dict], ids: list[str]) -> list[str]:
+        vectors = np.array(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        faiss.normalize_L2(vectors)
+
+        start = self.ntotal
+        self.index.add(vectors)
+        self.new_vectors.extend(vectors)
+        self.new_metadatas.extend(
+            {**metadata, 'doc_type': self.doc_type} for metadata in metadatas)
+        if self._metadata_index is not None:
+            self._metadata_index.add_many(
+                start, self.new_metadatas[start - self.size:])
+        if self._rows is not None:
+            for i, metadata in enumerate(metadatas):
+                self._rows[metadata['id']] = start + i
+        return ids
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return quantize.encode(vectors, self.vector_dtype, self.quantizer).reshape(-1, self.dim)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return quantize.decode(codes, self.vector_dtype, self.quantizer).reshape(-1, self.dim)
+
+    def vectors_at(self, rows) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        saved = rows < self.size
+        vectors[saved] = self.decode(self.vectors[rows[saved]])
+        for j in np.flatnonzero(~saved):
+            vectors[j] = self.new_vectors[rows[j] - self.size]
+        return vectors
+
+    def all_vectors(self) -> np.ndarray:
+        vectors = self.decode(self.vectors)
+        if self.new_vectors:
+            vectors = np.concatenate([vectors, np.array(self.new_vectors)])
+        return vectors
+
+    def metadata(self, i: int) -> dict:
+        if i >= self.size:
+            return self.new_metadatas[i - self.size]
+
+        metadata = {}
+        for field in STRING_FIELDS:
+            offsets, blob = self.columns[field]
+            metadata[field] = bytes(blob[offsets[i]:offsets[i + 1]]).decode()
+        for field in FLOAT_FIELDS:
+            metadata[field] = float(self.columns[field][i])
+        for field in TAG_FIELDS:
+            offsets, tag_ids = self.columns[field]
+            mask = 0
+            for t in tag_ids[offsets[i]:offsets[i + 1]]:
+                mask |= self.tag_bits[field][t]
+            metadata[field] = MetaSet.from_mask(mask)
+        metadata['doc_type'] = self.doc_type
+        return metadata
+
+    def document(self, i: int) -> Document:
+        metadata = dict(self.metadata(i))
+        return Document(page_content=metadata['title'], metadata=metadata)
+
+    def save(self, path: str, index_spec: str, rows: np.ndarray = None,
+             index: faiss.Index = None) -> 'ColumnStore':
+        """Write every row to path and remap the store onto it; returns the store.
+
+        Rows already saved are carried over from the mapped files as they
+        are, so only rows added since the last save are encoded. Given
+        rows, only those rows are written, in that order, with index (over
+        the same rows; None for the default flat index), and a new store
+        over them is returned; this one is left as it was, so searches
+        already holding it finish on the old rows. This is how tombstoned
+        rows are compacted away.
+        """
+        os.makedirs(path, exist_ok=True)
+        compact = rows is not None
+        if self.vector_dtype == 'int8' and self.quantizer is None and self.ntotal:
+            self.quantizer = quantize.train_quantizer(self.all_vectors())
+
+        # Re-encoded vectors (set_vector_dtype) are no longer a map of the files
+        if not compact and isinstance(self.vectors, np.memmap) \
+                and os.path.abspath(path) != os.path.abspath(self.path):
+            vocab = self.append_rows(path)
+            rows = np.arange(self.ntotal, dtype=np.int64)
+        else:
+            if not compact:
+                rows = np.arange(self.ntotal, dtype=np.int64)
+            vocab = self.write_rows(path, rows)
+
+        dead = [j for j, i in enumerate(rows.tolist()) if i in self.dead]
+        np.save(os.path.join(path, 'deleted.npy'), np.array(dead, dtype=np.int64))
+        if self.quantizer is not None:
+            np.save(os.path.join(path, 'quantizer.npy'),
+                    faiss.vector_to_array(self.quantizer.trained))
+
+        index_path = os.path.join(self.path or '', 'index.faiss')
+        if compact:
+            if index is not None and not isinstance(index, faiss.IndexFlat):
+                faiss.write_index(index, os.path.join(path, 'index.faiss'))
+        elif self._index is None and os.path.isfile(index_path):
+            # Never loaded, so unchanged since the last save
+            shutil.copyfile(index_path, os.path.join(path, 'index.faiss'))
+        elif self._index is not None and not self._default_index \
+                and not isinstance(self._index, faiss.IndexFlat):
+            faiss.write_index(self._index, os.path.join(path, 'index.faiss'))
+
+        meta = {'doc_type': self.doc_type, 'dim': self.dim, 'vector_dtype': self.vector_dtype,
+                'size': len(rows), 'vocab': vocab, 'index_spec': index_spec}
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+        if compact:
+            store = ColumnStore.open(path)
+            if index is not None:
+                store._index = index
+            return store
+
+        self.map_columns(path, meta)
+        self.new_vectors = []
+        self.new_metadatas = []
+        if self._default_index and isinstance(self._index, faiss.IndexFlat) \
+                and self.vector_dtype != 'float32':
+            # Scan the new codes instead of the float32 stand-in
+            self._index = None
+        return self
+
+    def write_rows(self, path: str, rows: np.ndarray) -> dict:
+        """Write the given rows as fresh columns; returns the tag vocabulary."""
+        metadatas = [self.metadata(i) for i in rows]
+        codes = np.asarray(self.vectors)
+        if self.new_vectors:
+            codes = np.concatenate(
+                [codes, self.encode(np.array(self.new_vectors))])
+        np.save(os.path.join(path, 'vectors.npy'), codes[rows])
+        for field in STRING_FIELDS:
+            write_strings(path, field, [str(metadata.get(field, ''))
+                                        for metadata in metadatas])
+        for field in FLOAT_FIELDS:
+            np.save(os.path.join(path, f'{field}.npy'), np.array(
+                [metadata.get(field, 0.0) for metadata in metadatas], dtype=np.float32))
+
+        vocab = {field: list(self.vocab[field]) for field in TAG_FIELDS}
+        for field in TAG_FIELDS:
+            counts, ids = tag_lists(metadatas, field, vocab[field])
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(counts)
+            np.save(os.path.join(path, f'{field}.offsets.npy'), offsets)
+            np.save(os.path.join(path, f'{field}.ids.npy'),
+                    np.array(ids, dtype=np.int32))
+        return vocab
+
+    def append_rows(self, path: str) -> dict:
+        """Copy the saved columns to path and append the new rows to them."""
+        def carry(name: str, values: np.ndarray):
+            append_npy(os.path.join(self.path, name), os.path.join(path, name), values)
+
+        metadatas = self.new_metadatas
+        carry('vectors.npy', self.encode(np.array(self.new_vectors))
+              if self.new_vectors else np.zeros((0, self.dim)))
+        for field in STRING_FIELDS:
+            offsets, _ = self.columns[field]
+            encoded = [str(metadata.get(field, '')).encode() for metadata in metadatas]
+            carry(f'{field}.offsets.npy',
+                  offsets[-1] + np.cumsum([len(value) for value in encoded], dtype=np.int64))
+            shutil.copyfile(os.path.join(self.path, f'{field}.bytes'),
+                            os.path.join(path, f'{field}.bytes'))
+            with open(os.path.join(path, f'{field}.bytes'), 'ab') as fp:
+                fp.write(b''.join(encoded))
+        for field in FLOAT_FIELDS:
+            carry(f'{field}.npy', np.array(
+                [metadata.get(field, 0.0) for metadata in metadatas], dtype=np.float32))
+
+        vocab = {field: list(self.vocab[field]) for field in TAG_FIELDS}
+        for field in TAG_FIELDS:
+            offsets, _ = self.columns[field]
+            counts, ids = tag_lists(metadatas, field, vocab[field])
+            carry(f'{field}.offsets.npy', offsets[-1] + np.cumsum(counts, dtype=np.int64))
+            carry(f'{field}.ids.npy', np.array(ids, dtype=np.int32))
+        return vocab
+
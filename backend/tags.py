@@ -0,0 +1,74 @@
+import threading
+import csv
+import os
+
+
+TAG_STATS_DIR = 'mtgdataset/stats/autotagging_top50tags'
+TAG_FIELDS = ('genre', 'instrument', 'moodtheme')
+
+genres = ["electronic", "rock", "pop", "ambient", "soundtrack", "alternative", "experimental",     "easylistening", "classical", "dance", "chillout", "jazz", "poprock", "indie", "world",     "folk", "techno", "hiphop", "lounge", "house", "funk", "orchestral", "popfolk",     "atmospheric", "trance", "instrumentalpop", "newage", "blues", "metal", "progressive",     "electropop", "triphop", "reggae", "downtempo", "minimal", "rap", "rnb", "punkrock",     "psychedelic", "instrumentalrock", "industrial", "latin", "dubstep", "drumnbass",     "ethno", "fusion", "club",
+          "symphonic", "country", "electronica", "disco",     "singersongwriter", "darkambient", "breakbeat", "soul", "synthpop", "dub", "hardrock",     "rocknroll", "80s", "contemporary", "eurodance", "grunge", "improvisation", "postrock",     "groove", "90s", "alternativerock", "deephouse", "celtic", "jazzfunk", "idm", "bossanova",     "darkwave", "swing", "70s", "acidjazz", "classicrock", "newwave", "oriental", "hard",     "chanson", "ethnicrock", "jazzfusion", "60s", "choir", "edm", "ska", "gothic",     "worldfusion", "bluesrock", "heavymetal", "medieval", "tribal", "african"]
+
+instruments = ["piano", "synthesizer", "bass", "drums", "guitar", "electricguitar",     "acousticguitar", "violin", "voice", "computer", "keyboard", "strings",     "drummachine", "flute", "electricpiano", "cello", "saxophone", "trumpet",     "percussion",
+               "sampler", "orchestra", "beat", "classicalguitar", "bell",     "doublebass", "accordion", "harp", "viola", "horn", "rhodes", "pipeorgan",     "brass", "acousticbassguitar", "organ", "clarinet", "trombone", "harmonica",     "pad", "ukulele", "bongo", "oboe"]
+
+moods_themes = ["love", "happy", "energetic", "dark", "relaxing", "melodic", "sad", "dream",     "film", "emotional", "epic", "romantic", "melancholic", "space", "meditative",     "uplifting", "ballad", "inspiring", "calm", "soft", "slow", "fun", "christmas",     "motivational", "positive", "upbeat", "dramatic", "deep", "children",
+                "adventure",     "soundscape", "summer", "powerful", "hopeful", "advertising", "party", "background",     "action", "movie", "drama", "nature", "cool", "funny", "documentary", "horror",     "fast", "ambiental", "groovy", "corporate", "commercial", "travel", "sport",     "mellow", "retro", "game", "sexy", "trailer", "heavy", "holiday"]
+
+
+def read_tag_stats(filename: str) -> list[str]:
+    """Tags listed in one of the MTG-Jamendo top-50 tag statistics files."""
+    path = os.path.join(TAG_STATS_DIR, filename)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as fp:
+        reader = csv.reader(fp, delimiter='\t')
+        next(reader, None)  # skip header
+        return [row[0] for row in reader]
+
+
+class TagVocabulary():
+    """Maps every tag string to a bit position, shared by all categories.
+
+    Known genre, instrument and mood/theme tags get fixed low bits; tags
+    seen for the first time are appended, so bit positions are only
+    stable within a process. Bitmasks are therefore never persisted; the
+    stores and the write-ahead log keep tag strings.
+    """
+
+    def __init__(self, tags: list[str] = ()):
+        self.lock = threading.Lock()
+        self.tags = []
+        self.bits = {}
+        for tag in tags:
+            self.bit(tag)
+
+    def bit(self, tag: str) -> int:
+        bit = self.bits.get(tag)
+        if bit is None:
+            with self.lock:
+                bit = self.bits.setdefault(tag, len(self.tags))
+                if bit == len(self.tags):
+                    self.tags.append(tag)
+        return bit
+
+    def mask(self, tags) -> int:
+        mask = 0
+        for tag in tags:
+            mask |= 1 << self.bit(tag)
+        return mask
+
+    def items(self, mask: int) -> set[str]:
+        items = set()
+        while mask:
+            low = mask & -mask
+            items.add(self.tags[low.bit_length() - 1])
+            mask ^= low
+        return items
+
+    def __len__(self):
+        return len(self.tags)
+
+
+TAGS = TagVocabulary(genres + instruments + moods_themes + read_tag_stats('genre.tsv') +
+                     read_tag_stats('instrument.tsv') + read_tag_stats('mood_theme.tsv'))
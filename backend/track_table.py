@@ -0,0 +1,193 @@
+"""Columnar, memory-mapped view of the MTG-Jamendo metadata TSV.
+
+Example:
+    python backend/track_table.py mtgdataset/data/autotagging.tsv
+"""
+from collections.abc import Mapping
+import numpy as np
+import argparse
+import shutil
+import json
+import csv
+import os
+
+from commons import CATEGORIES, TAG_HYPHEN, get_id
+from columns import write_strings, open_bytes
+
+
+# Bump when the cached layout changes
+CACHE_VERSION = 2
+
+
+def category_file(category: str) -> str:
+    return category.replace('/', '_')
+
+
+def source_stamp(tsv_file: str) -> dict:
+    stat = os.stat(tsv_file)
+    return {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class TrackTable(Mapping):
+    """Track metadata as sorted columns instead of a dict of dicts.
+
+    Track, artist and album ids are integer arrays, durations a float
+    array and paths one UTF-8 blob; each category's tags are stored
+    CSR-style, as per-track offsets into one array of tag ids that index
+    the category's vocabulary. Every column is memory-mapped, so opening
+    the table reads only meta.json. Lookups are a binary search on the
+    track ids and return the same dict read_file() builds for a track.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+        self.vocab = self.meta['vocab']
+        self.columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                        for name in ('track_id', 'artist_id', 'album_id', 'duration',
+                                     'path.offsets')}
+        for category in CATEGORIES:
+            for column in ('offsets', 'tags'):
+                name = f'{category_file(category)}.{column}'
+                self.columns[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        self.paths = open_bytes(os.path.join(path, 'path.bytes'))
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.columns['track_id']
+
+    def row(self, id) -> int:
+        """Row of track id, or -1."""
+        ids = self.ids
+        i = int(np.searchsorted(ids, id))
+        if i < len(ids) and ids[i] == id:
+            return i
+        return -1
+
+    def tag_ids(self, category: str, i: int) -> np.ndarray:
+        offsets = self.columns[f'{category_file(category)}.offsets']
+        return self.columns[f'{category_file(category)}.tags'][offsets[i]:offsets[i + 1]]
+
+    def tags(self, category: str, i: int) -> set:
+        vocab = self.vocab[category]
+        return {vocab[t] for t in self.tag_ids(category, i)}
+
+    def __getitem__(self, id) -> dict:
+        i = self.row(id)
+        if i < 0:
+            raise KeyError(id)
+        offsets = self.columns['path.offsets']
+        track = {'artist_id': int(self.columns['artist_id'][i]),
+                 'album_id': int(self.columns['album_id'][i]),
+                 'path': bytes(self.paths[offsets[i]:offsets[i + 1]]).decode(),
+                 'duration': float(self.columns['duration'][i])}
+        track.update({category: self.tags(category, i) for category in CATEGORIES})
+        # Rebuilt per tag rather than kept verbatim from the TSV
+        track['tags'] = sorted(category + TAG_HYPHEN + tag
+                               for category in CATEGORIES for tag in track[category])
+        return track
+
+    def __contains__(self, id) -> bool:
+        try:
+            return self.row(id) >= 0
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def tracks_with(self, category: str, tag: str) -> np.ndarray:
+        """Ids of the tracks carrying tag, read from the CSR columns."""
+        if tag not in self.vocab[category]:
+            return np.zeros(0, dtype=self.ids.dtype)
+        offsets = self.columns[f'{category_file(category)}.offsets']
+        hits = self.columns[f'{category_file(category)}.tags'] == self.vocab[category].index(tag)
+        rows = np.searchsorted(offsets, np.flatnonzero(hits), side='right') - 1
+        return self.ids[np.unique(rows)]
+
+
+def parse_tsv(tsv_file: str, path: str):
+    """Parse tsv_file once and write its columns to path."""
+    rows = []
+    with open(tsv_file) as fp:
+        reader = csv.reader(fp, delimiter='\t')
+        next(reader, None)  # skip header
+        for row in reader:
+            tags = {category: set() for category in CATEGORIES}
+            for tag_str in row[5:]:
+                category, tag = tag_str.split(TAG_HYPHEN)
+                tags.setdefault(category, set()).update(tag.split(','))
+            rows.append((get_id(row[0]), get_id(row[1]), get_id(row[2]),
+                         row[3], float(row[4]), tags))
+    # Later rows win, as in read_file()
+    rows = sorted({row[0]: row for row in rows}.values(), key=lambda row: row[0])
+
+    os.makedirs(path)
+    np.save(os.path.join(path, 'track_id.npy'), np.array([row[0] for row in rows], dtype=np.int64))
+    np.save(os.path.join(path, 'artist_id.npy'), np.array([row[1] for row in rows], dtype=np.int32))
+    np.save(os.path.join(path, 'album_id.npy'), np.array([row[2] for row in rows], dtype=np.int32))
+    np.save(os.path.join(path, 'duration.npy'), np.array([row[4] for row in rows], dtype=np.float64))
+    write_strings(path, 'path', [row[3] for row in rows])
+
+    vocab = {}
+    for category in CATEGORIES:
+        vocab[category] = sorted({tag for row in rows for tag in row[5].get(category, ())})
+        tag_ids = {tag: t for t, tag in enumerate(vocab[category])}
+        lists = [sorted(tag_ids[tag] for tag in row[5].get(category, ())) for row in rows]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(tags) for tags in lists])
+        np.save(os.path.join(path, f'{category_file(category)}.offsets.npy'), offsets)
+        np.save(os.path.join(path, f'{category_file(category)}.tags.npy'),
+                np.array([t for tags in lists for t in tags], dtype=np.int16))
+    return vocab, len(rows)
+
+
+def load_tracks(tsv_file: str, cache_dir: str = None) -> TrackTable:
+    """TrackTable of tsv_file, parsing it only when the cache is stale.
+
+    The cache lives in cache_dir (default tsv_file + '.cache') and is
+    rebuilt whenever the TSV's size or modification time changes. It is
+    written to a temporary directory and renamed into place, so scrapers
+    starting together never read a half-written cache.
+    """
+    cache_dir = cache_dir or tsv_file + '.cache'
+    stamp = source_stamp(tsv_file)
+    try:
+        table = TrackTable(cache_dir)
+        if table.meta['source'] == stamp:
+            return table
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+
+    tmp = f'{cache_dir}.tmp{os.getpid()}'
+    shutil.rmtree(tmp, ignore_errors=True)
+    vocab, n = parse_tsv(tsv_file, tmp)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as fp:
+        json.dump({'source': stamp, 'tracks': n, 'vocab': vocab}, fp)
+
+    old = f'{cache_dir}.old{os.getpid()}'
+    if os.path.isdir(cache_dir):
+        os.replace(cache_dir, old)
+    try:
+        os.replace(tmp, cache_dir)
+    except OSError:
+        # Another process installed a fresh cache first
+        shutil.rmtree(tmp, ignore_errors=True)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f'Cached {n} tracks from {tsv_file} in {cache_dir}')
+    return TrackTable(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('tsv')
+    parser.add_argument('--cache-dir')
+    args = parser.parse_args()
+
+    table = load_tracks(args.tsv, args.cache_dir)
+    print(f'{len(table)} tracks; '
+          + ', '.join(f'{len(table.vocab[category])} {category} tags' for category in CATEGORIES))
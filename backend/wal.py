@@ -0,0 +1,109 @@
+import numpy as np
+import struct
+import json
+import os
+
+from songs import MetaSet
+
+
+# Each record is a header with the JSON and vector byte lengths, the JSON
+# (op, doc_type, titles, metadatas, ids) and the raw float32 vectors.
+# Records without an op are adds, as written before upserts existed.
+OPS = ('add', 'upsert', 'delete')
+HEADER = struct.Struct('<II')
+
+
+def encode_value(value):
+    if isinstance(value, MetaSet):
+        return {'__metaset__': sorted(value.items)}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and '__metaset__' in value:
+        return MetaSet(set(value['__metaset__']))
+    return value
+
+
+class WriteAheadLog():
+    """Append-only log of changes since the last checkpoint.
+
+    An 'add' or 'upsert' record carries vectors; a 'delete' record only
+    the song ids whose rows were tombstoned.
+
+    Records are fsynced before the change is applied in memory. A record
+    cut short by a crash is dropped (and truncated away) on replay.
+    """
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.fp = None
+        self.records = 0
+
+    def append(self, doc_type: str, titles: list[str], embeddings: list[list[float]],
+               metadatas: list[dict], ids: list[str], op: str = 'add'):
+        if op not in OPS:
+            raise ValueError(f'Unknown write-ahead log op {op}')
+        header = json.dumps({
+            'op': op,
+            'doc_type': doc_type,
+            'titles': titles,
+            'metadatas': [{key: encode_value(value) for key, value in metadata.items()}
+                          for metadata in metadatas],
+            'ids': ids,
+        }).encode()
+        vectors = np.asarray(embeddings, dtype=np.float32).tobytes()
+
+        if self.fp is None:
+            self.fp = open(self.path, 'ab')
+        self.fp.write(HEADER.pack(len(header), len(vectors)) + header + vectors)
+        self.fp.flush()
+        if self.fsync:
+            os.fsync(self.fp.fileno())
+        self.records += 1
+
+    def delete(self, doc_type: str, ids: list[str]):
+        self.append(doc_type, [], [], [], ids, op='delete')
+
+    def replay(self):
+        """Yield (op, doc_type, titles, embeddings, metadatas, ids) for each complete record."""
+        if not os.path.isfile(self.path):
+            return
+
+        valid = 0
+        with open(self.path, 'rb') as fp:
+            while True:
+                header = fp.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                header_len, vectors_len = HEADER.unpack(header)
+                body = fp.read(header_len)
+                vectors = fp.read(vectors_len)
+                if len(body) < header_len or len(vectors) < vectors_len:
+                    break
+
+                record = json.loads(body)
+                embeddings = np.frombuffer(vectors, dtype=np.float32).reshape(
+                    len(record['ids']), -1)
+                metadatas = [{key: decode_value(value) for key, value in metadata.items()}
+                             for metadata in record['metadatas']]
+                valid = fp.tell()
+                self.records += 1
+                yield (record.get('op', 'add'), record['doc_type'], record['titles'],
+                       embeddings, metadatas, record['ids'])
+
+        if valid < os.path.getsize(self.path):
+            print(f'Dropping torn record at the end of {self.path}.')
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(valid)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
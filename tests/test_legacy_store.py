@@ -0,0 +1,108 @@
+"""Stores pickled by the baseline langchain layout must still open."""
+import subprocess
+import textwrap
+import sys
+import os
+
+import numpy as np
+import pytest
+
+BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path.insert(0, BACKEND)
+
+# songs.py as it was when the langchain stores were pickled
+BASELINE_SONGS = '''
+class Song():
+    def __init__(self, title, path, id, artist="", url="", duration=0.0,
+                 genre=set(), instrument=set(), moodtheme=set(), description=""):
+        self.title = title.lower()
+        self.path = path
+        self.artist = artist.lower()
+        self.url = url
+        self.id = str(id)
+        self.duration = duration
+        self.genre = MetaSet(set([g.lower() for g in genre]))
+        self.instrument = MetaSet(set([i.lower() for i in instrument]))
+        self.moodtheme = MetaSet(set([m.lower() for m in moodtheme]))
+        self.description = description
+
+    def get_metadata(self):
+        return vars(self)
+
+
+class MetaSet():
+    def __init__(self, items=set()):
+        self.items = items
+'''
+
+# Writes a single-index store (audio, text and mixed rows) as the baseline did
+WRITE_STORE = '''
+import sys
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from songs import Song
+
+path, dim = sys.argv[1], int(sys.argv[2])
+rng = np.random.default_rng(0)
+index = faiss.IndexFlatIP(dim)
+docs, ids = {}, {}
+for i in range(4):
+    song = Song(f'song {i}', f'{i}.mp3', i, genre={'rock'} if i % 2 else {'jazz'},
+                duration=60.0 * (i + 1))
+    for doc_type in ('audio', 'text', 'mixed'):
+        doc_id = f'{doc_type}_{i}'
+        ids[len(ids)] = doc_id
+        docs[doc_id] = Document(page_content=song.title,
+                                metadata={**song.get_metadata(), 'doc_type': doc_type})
+vectors = rng.standard_normal((len(ids), dim)).astype(np.float32)
+faiss.normalize_L2(vectors)
+index.add(vectors)
+FAISS(None, index, InMemoryDocstore(docs), ids).save_local(path)
+'''
+
+
+@pytest.fixture
+def legacy_store(tmp_path, monkeypatch):
+    from embeddings import MODELS
+
+    baseline = tmp_path / 'baseline'
+    baseline.mkdir()
+    (baseline / 'songs.py').write_text(textwrap.dedent(BASELINE_SONGS))
+    store = tmp_path / 'backend' / 'vector_stores' / 'legacy'
+    subprocess.run([sys.executable, '-c', WRITE_STORE, str(store), str(MODELS.dim())],
+                   cwd=baseline, check=True)
+    monkeypatch.chdir(tmp_path)
+    return store
+
+
+def test_baseline_metaset_unpickles(legacy_store):
+    import pickle
+    from songs import MetaSet
+
+    with open(legacy_store / 'index.pkl', 'rb') as fp:
+        docstore, _ = pickle.load(fp)
+    genre = docstore.search('audio_1').metadata['genre']
+    assert isinstance(genre, MetaSet) and genre.items == {'rock'}
+    assert pickle.loads(pickle.dumps(genre)).items == {'rock'}
+
+
+def test_legacy_store_opens(legacy_store):
+    from database import Database
+    from songs import MetaSet
+    from embeddings import MODELS
+
+    db = Database('legacy', True)
+    assert db.sizes() == {'audio': 4, 'text': 4}
+    assert db.stores['audio'].metadata(db.stores['audio'].rows['1'])['genre'].items == {'rock'}
+
+    query = np.random.default_rng(1).standard_normal((1, MODELS.dim())).astype(np.float32)
+    found = db.search(query, 10, {'doc_type': 'audio', 'genre': MetaSet({'rock'})})[0]
+    assert sorted(doc.metadata['id'] for doc, _ in found) == ['1', '3']
+
+    # Converted once and checkpointed, so reopening skips the pickle
+    assert os.path.isfile(os.path.join(db.checkpoint_path(db.generation), 'audio', 'meta.json'))
+    os.remove(legacy_store / 'index.pkl')
+    assert Database('legacy', True).sizes() == {'audio': 4, 'text': 4}